@@ -0,0 +1,275 @@
+"""Admission control in front of the detection pipeline.
+
+Each message is charged an estimated detection cost against token buckets
+for its session and its client IP, and detection runs through a bounded
+queue. Requests that would exceed either limit are rejected straight away
+so one client cannot hold up everyone else.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlite_connections import ThreadLocalConnection
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is refused by admission control"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def estimate_detection_cost(message_length, history_length):
+    """Estimate the relative detection cost of a message in bucket tokens"""
+    # Detection work grows with the message length and with the history
+    # the cross-message checks have to combine it with
+    return 1.0 + message_length / 1000.0 + history_length / 20.0
+
+
+def refill(tokens, updated, now, rate, capacity):
+    """Tokens in a bucket after refilling it at `rate` tokens per second"""
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+class MemoryBucketStore:
+    """Token buckets held in process memory (one set per worker)"""
+
+    def __init__(self, clock=time.monotonic, prune_every=1000):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.prune_every = prune_every
+        self.calls = 0
+
+    def consume(self, limits, cost):
+        """Take `cost` tokens from every bucket or from none of them.
+
+        `limits` maps a bucket key to its (rate, capacity). Returns
+        (allowed, retry_after) where retry_after is in seconds.
+        """
+        now = self.clock()
+        with self.lock:
+            levels = {}
+            retry_after = 0.0
+            for key, (rate, capacity) in limits.items():
+                tokens, updated = self.buckets.get(key, (capacity, now))
+                levels[key] = refill(tokens, updated, now, rate, capacity)
+                needed = min(cost, capacity)
+                if levels[key] < needed:
+                    retry_after = max(retry_after, (needed - levels[key]) / rate)
+
+            # A message costing more than a bucket holds is admitted once the bucket is
+            # full, and leaves it in debt until the rest has been paid off
+            if retry_after == 0.0:
+                for key in limits:
+                    levels[key] -= cost
+
+            for key, level in levels.items():
+                self.buckets[key] = (level, now)
+
+            self.calls += 1
+            if self.calls % self.prune_every == 0:
+                self.prune(now, limits)
+
+        return retry_after == 0.0, retry_after
+
+    def refund(self, limits, cost):
+        """Give back `cost` tokens taken by consume, up to each bucket's capacity"""
+        now = self.clock()
+        with self.lock:
+            for key, (rate, capacity) in limits.items():
+                tokens, updated = self.buckets.get(key, (capacity, now))
+                self.buckets[key] = (min(capacity, refill(tokens, updated, now, rate, capacity) + cost), now)
+
+    def prune(self, now, limits):
+        """Forget buckets that have been idle long enough to be full again"""
+        slowest_rate = min(rate for rate, _ in limits.values())
+        largest_capacity = max(capacity for _, capacity in limits.values())
+        idle = [key for key, (tokens, updated) in self.buckets.items()
+                if tokens + (now - updated) * slowest_rate >= largest_capacity]
+        for key in idle:
+            del self.buckets[key]
+
+
+class SQLiteBucketStore:
+    """Token buckets shared between worker processes through a SQLite file"""
+
+    def __init__(self, path, clock=time.time, prune_every=1000):
+        self.path = path
+        self.clock = clock
+        self.connection = ThreadLocalConnection(path)
+        self.prune_every = prune_every
+        self.calls = 0
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS token_buckets ('
+            'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)'
+        )
+
+    def consume(self, limits, cost):
+        """Take `cost` tokens from every bucket or from none of them, atomically across processes"""
+        connection = self.connection()
+        now = self.clock()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            levels = {}
+            retry_after = 0.0
+            for key, (rate, capacity) in limits.items():
+                row = connection.execute(
+                    'SELECT tokens, updated FROM token_buckets WHERE key = ?', (key,)
+                ).fetchone()
+                tokens, updated = row if row else (capacity, now)
+                levels[key] = refill(tokens, updated, now, rate, capacity)
+                needed = min(cost, capacity)
+                if levels[key] < needed:
+                    retry_after = max(retry_after, (needed - levels[key]) / rate)
+
+            # Charge the full cost, which can leave a bucket in debt (see MemoryBucketStore)
+            if retry_after == 0.0:
+                for key in limits:
+                    levels[key] -= cost
+
+            connection.executemany(
+                'INSERT OR REPLACE INTO token_buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                [(key, level, now) for key, level in levels.items()]
+            )
+
+            self.calls += 1
+            if self.calls % self.prune_every == 0:
+                # Buckets still in debt are kept until they have refilled
+                slowest_rate = min(rate for rate, _ in limits.values())
+                largest_capacity = max(capacity for _, capacity in limits.values())
+                connection.execute('DELETE FROM token_buckets WHERE tokens + (? - updated) * ? >= ?',
+                                   (now, slowest_rate, largest_capacity))
+
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        return retry_after == 0.0, retry_after
+
+    def refund(self, limits, cost):
+        """Give back `cost` tokens taken by consume, up to each bucket's capacity"""
+        connection = self.connection()
+        now = self.clock()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            levels = {}
+            for key, (rate, capacity) in limits.items():
+                row = connection.execute(
+                    'SELECT tokens, updated FROM token_buckets WHERE key = ?', (key,)
+                ).fetchone()
+                tokens, updated = row if row else (capacity, now)
+                levels[key] = min(capacity, refill(tokens, updated, now, rate, capacity) + cost)
+
+            connection.executemany(
+                'INSERT OR REPLACE INTO token_buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                [(key, level, now) for key, level in levels.items()]
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+
+class BoundedQueue:
+    """Limit concurrent detections and how many requests may wait for a slot"""
+
+    def __init__(self, max_concurrent, max_waiting, timeout):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+
+    @contextmanager
+    def slot(self):
+        """Hold a detection slot, raising AdmissionRejected when the queue is full"""
+        with self.condition:
+            if self.active >= self.max_concurrent:
+                if self.waiting >= self.max_waiting:
+                    raise AdmissionRejected('queue_full', self.timeout)
+                self.waiting += 1
+                try:
+                    acquired = self.condition.wait_for(lambda: self.active < self.max_concurrent, self.timeout)
+                finally:
+                    self.waiting -= 1
+                if not acquired:
+                    raise AdmissionRejected('queue_timeout', self.timeout)
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify()
+
+
+class AdmissionController:
+    """Per-session and per-IP token buckets plus a bounded detection queue"""
+
+    def __init__(self, store, session_rate, session_capacity, ip_rate, ip_capacity,
+                 max_concurrent, max_waiting, queue_timeout):
+        self.store = store
+        self.session_limit = (session_rate, session_capacity)
+        self.ip_limit = (ip_rate, ip_capacity)
+        self.queue = BoundedQueue(max_concurrent, max_waiting, queue_timeout)
+
+    def limits(self, session_id, ip_address):
+        """Bucket keys of a session and client IP, with their (rate, capacity)"""
+        return {
+            'session:' + session_id: self.session_limit,
+            'ip:' + (ip_address or 'unknown'): self.ip_limit,
+        }
+
+    def admit(self, session_id, ip_address, message_length, history_length):
+        """Charge a message to its session and IP buckets, raising AdmissionRejected if either is empty"""
+        cost = estimate_detection_cost(message_length, history_length)
+        allowed, retry_after = self.store.consume(self.limits(session_id, ip_address), cost)
+        if not allowed:
+            raise AdmissionRejected('rate_limited', retry_after)
+
+    @contextmanager
+    def admitted(self, session_id, ip_address, message_length, history_length):
+        """Charge a message, then hold a detection slot for it.
+
+        A message turned away by a full queue never ran, so its charge is
+        refunded before the rejection is raised.
+        """
+        self.admit(session_id, ip_address, message_length, history_length)
+        started = False
+        try:
+            with self.queue.slot():
+                started = True
+                yield
+        except AdmissionRejected:
+            if not started:
+                cost = estimate_detection_cost(message_length, history_length)
+                self.store.refund(self.limits(session_id, ip_address), cost)
+            raise
+
+    def slot(self):
+        """Context manager holding one of the bounded detection slots"""
+        return self.queue.slot()
+
+
+def create_admission_controller(config):
+    """Build the admission controller described by the Flask config"""
+    if config['ADMISSION_BACKEND'] == 'sqlite':
+        store = SQLiteBucketStore(config['ADMISSION_DB'])
+    else:
+        store = MemoryBucketStore()
+
+    return AdmissionController(
+        store,
+        session_rate=config['ADMISSION_SESSION_RATE'],
+        session_capacity=config['ADMISSION_SESSION_BURST'],
+        ip_rate=config['ADMISSION_IP_RATE'],
+        ip_capacity=config['ADMISSION_IP_BURST'],
+        max_concurrent=config['ADMISSION_MAX_CONCURRENT'],
+        max_waiting=config['ADMISSION_MAX_QUEUE'],
+        queue_timeout=config['ADMISSION_QUEUE_TIMEOUT'],
+    )
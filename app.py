@@ -1,23 +1,98 @@
 from flask import Flask, render_template, request, session
 from presidio_analyzer import AnalyzerEngine, PatternRecognizer, Pattern
+from admission import AdmissionRejected, create_admission_controller
+from blocklist import Blocklist, detail_kinds
+from conversation_cache import ConversationCache, SQLiteConversationStore
+from number_lexicons import available_locales, get_number_lexicon, guess_locale, number_words_snapshot
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import copy
+import hashlib
+import json
+import math
+import multiprocessing
+import os
 import re
+import sys
+import threading
+import unicodedata
+import uuid
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'  # Change this to a secure secret key
 
+# Two-tier detection: when enabled, only the cheap detectors run inside the
+# request and the deep detectors run on a background pool
+app.config['ASYNC_DEEP_DETECTION'] = os.environ.get('ASYNC_DEEP_DETECTION', '0') == '1'
+app.config['DEEP_DETECTION_WORKERS'] = int(os.environ.get('DEEP_DETECTION_WORKERS', '4'))
+app.config['DEEP_DETECTION_MAX_PENDING'] = int(os.environ.get('DEEP_DETECTION_MAX_PENDING', '10000'))
+
+# Messages longer than this are split into overlapping chunks scanned on a process pool
+app.config['CHUNK_SCAN_THRESHOLD'] = int(os.environ.get('CHUNK_SCAN_THRESHOLD', '4000'))
+app.config['CHUNK_SCAN_SIZE'] = int(os.environ.get('CHUNK_SCAN_SIZE', '2000'))
+app.config['CHUNK_SCAN_WORKERS'] = int(os.environ.get('CHUNK_SCAN_WORKERS', str(os.cpu_count() or 1)))
+
+# Admission control: per-session and per-IP token buckets weighted by detection cost
+# ('memory' keeps buckets per worker, 'sqlite' shares them through ADMISSION_DB)
+app.config['ADMISSION_CONTROL'] = os.environ.get('ADMISSION_CONTROL', '1') == '1'
+app.config['ADMISSION_BACKEND'] = os.environ.get('ADMISSION_BACKEND', 'memory')
+app.config['ADMISSION_DB'] = os.environ.get('ADMISSION_DB', 'admission.sqlite3')
+app.config['ADMISSION_SESSION_RATE'] = float(os.environ.get('ADMISSION_SESSION_RATE', '2'))
+app.config['ADMISSION_SESSION_BURST'] = float(os.environ.get('ADMISSION_SESSION_BURST', '20'))
+app.config['ADMISSION_IP_RATE'] = float(os.environ.get('ADMISSION_IP_RATE', '20'))
+app.config['ADMISSION_IP_BURST'] = float(os.environ.get('ADMISSION_IP_BURST', '200'))
+app.config['ADMISSION_MAX_CONCURRENT'] = int(os.environ.get('ADMISSION_MAX_CONCURRENT', '8'))
+app.config['ADMISSION_MAX_QUEUE'] = int(os.environ.get('ADMISSION_MAX_QUEUE', '32'))
+app.config['ADMISSION_QUEUE_TIMEOUT'] = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '5'))
+
+# Hot cache of per-conversation detection state, written behind to CONVERSATION_STORE
+# (a SQLite file) when one is configured
+app.config['CONVERSATION_CACHE'] = os.environ.get('CONVERSATION_CACHE', '1') == '1'
+app.config['CONVERSATION_CACHE_MAX_BYTES'] = int(os.environ.get('CONVERSATION_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+app.config['CONVERSATION_CACHE_TTL'] = float(os.environ.get('CONVERSATION_CACHE_TTL', '1800'))
+app.config['CONVERSATION_CACHE_HISTORY'] = int(os.environ.get('CONVERSATION_CACHE_HISTORY', '8'))
+app.config['CONVERSATION_CACHE_FLUSH_INTERVAL'] = float(os.environ.get('CONVERSATION_CACHE_FLUSH_INTERVAL', '2'))
+app.config['CONVERSATION_STORE'] = os.environ.get('CONVERSATION_STORE', '')
+
+# Number-word locales every conversation is scanned with; other installed locales
+# are added per conversation when its language is guessed or set explicitly
+app.config['DEFAULT_LOCALES'] = tuple(os.environ.get('DEFAULT_LOCALES', 'en,es').split(','))
+
+# JSON file remembering the contents of past lexicon versions, so a lexicon change
+# only re-evaluates the messages it can affect
+app.config['LEXICON_SNAPSHOTS'] = os.environ.get('LEXICON_SNAPSHOTS', '')
+
+# Memory-mapped blocklist of known leaked contacts (built with blocklist.py), and how
+# often workers check whether it was replaced
+app.config['BLOCKLIST'] = os.environ.get('BLOCKLIST', '')
+app.config['BLOCKLIST_CHECK_INTERVAL'] = float(os.environ.get('BLOCKLIST_CHECK_INTERVAL', '5'))
+
+# Number of history messages rendered per page
+app.config['HISTORY_PAGE_SIZE'] = int(os.environ.get('HISTORY_PAGE_SIZE', '20'))
+app.config['HISTORY_PAGE_SIZE_MAX'] = 100
+
 # Initialize the analyzer engine
 analyzer = AnalyzerEngine()
 
-# Dictionary to convert word numbers to digits
-number_words = {
-    'zero': '0', 'one': '1', 'two': '2', 'three': '3', 'four': '4',
-    'five': '5', 'six': '6', 'seven': '7', 'eight': '8', 'nine': '9',
-    'oh': '0', 'o': '0', 'null': '0', 'cero': '0', 'sero': '0',
-    'i': '1', 'l': '1', '1': '1', 'I': '1', 'L': '1',  # Common replacements for '1'
-    # Spanish numbers
-    'uno': '1', 'dos': '2', 'tres': '3', 'cuatro': '4', 'cinco': '5',
-    'seis': '6', 'siete': '7', 'ocho': '8', 'nueve': '9'
-}
+# Initialize admission control for the detection pipeline
+admission_controller = create_admission_controller(app.config) if app.config['ADMISSION_CONTROL'] else None
+
+# Initialize the hot conversation state cache
+conversation_cache = None
+if app.config['CONVERSATION_CACHE']:
+    conversation_cache = ConversationCache(
+        max_bytes=app.config['CONVERSATION_CACHE_MAX_BYTES'],
+        idle_ttl=app.config['CONVERSATION_CACHE_TTL'],
+        store=SQLiteConversationStore(app.config['CONVERSATION_STORE']) if app.config['CONVERSATION_STORE'] else None,
+        flush_interval=app.config['CONVERSATION_CACHE_FLUSH_INTERVAL']
+    )
+
+# Map the blocklist of known leaked contacts
+blocklist = None
+if app.config['BLOCKLIST']:
+    blocklist = Blocklist(app.config['BLOCKLIST'], check_interval=app.config['BLOCKLIST_CHECK_INTERVAL'])
 
 # Marketplace-specific context words
 marketplace_context = {
@@ -51,6 +126,65 @@ country_codes = {
     '+971': 'UAE', '+972': 'Israel', '+30': 'Greece', '+27': 'South Africa'
 }
 
+# National significant number lengths (without the country code) for each country
+national_number_lengths = {
+    '+1': (10,), '+44': (10,), '+33': (9,), '+49': (10, 11),
+    '+61': (9,), '+86': (11,), '+91': (10,), '+52': (10,),
+    '+55': (10, 11), '+81': (10,), '+82': (9, 10), '+7': (10,),
+    '+34': (9,), '+39': (9, 10), '+31': (9,), '+46': (7, 8, 9),
+    '+41': (9,), '+64': (8, 9), '+65': (8,), '+66': (8, 9),
+    '+971': (8, 9), '+972': (8, 9), '+30': (10,), '+27': (9,)
+}
+
+# NANP toll-free area codes
+nanp_toll_free_codes = {'800', '888', '877', '866', '855', '844', '833', '822'}
+
+NANP_GEOGRAPHIC = 1
+NANP_TOLL_FREE = 2
+
+def build_nanp_tables():
+    """Compile the NANP area code and exchange rules into 1000 entry lookup arrays"""
+    area_codes = bytearray(1000)
+    exchanges = bytearray(1000)
+    for code in range(200, 1000):
+        first, second, third = code // 100, code // 10 % 10, code % 10
+        # N11 codes are service numbers
+        if second == 1 and third == 1:
+            continue
+        exchanges[code] = NANP_GEOGRAPHIC
+        # N9X, 37X and 96X area codes are reserved
+        if second == 9 or (first, second) in ((3, 7), (9, 6)):
+            continue
+        area_codes[code] = NANP_GEOGRAPHIC
+    for code in nanp_toll_free_codes:
+        area_codes[int(code)] = NANP_TOLL_FREE
+    return area_codes, exchanges
+
+nanp_area_codes, nanp_exchanges = build_nanp_tables()
+
+def build_country_code_trie():
+    """Compile country_codes into an array-backed digit trie.
+    
+    Node n keeps its ten children at trie[n * 10:n * 10 + 10] (-1 for none),
+    terminal[n] is the index of the country code ending there (-1 for none).
+    """
+    entries = sorted(country_codes.items())
+    trie = array('i', [-1] * 10)
+    terminal = array('i', [-1])
+    for index, (code, _) in enumerate(entries):
+        node = 0
+        for digit in code[1:]:
+            slot = node * 10 + int(digit)
+            if trie[slot] < 0:
+                trie[slot] = len(terminal)
+                trie.extend([-1] * 10)
+                terminal.append(-1)
+            node = trie[slot]
+        terminal[node] = index
+    return trie, terminal, entries
+
+country_code_trie, country_code_terminal, country_code_entries = build_country_code_trie()
+
 # Add text obfuscation tricks people might use
 obfuscation_patterns = {
     'email': ['mail', 'em ail', 'e mail', 'e-m-a-i-l', 'electronic mail', 'inbox'],
@@ -61,6 +195,120 @@ obfuscation_patterns = {
 # Add common ways to separate numbers or evade detection
 separator_chars = [' ', '.', '-', '_', '|', '/', '\\', ':', ';', ',', '*', '+', '(', ')', '[', ']', '{', '}']
 
+# Lookalike letters that survive NFKC folding, mapped to the ASCII they imitate. Only
+# folded inside tokens that also contain Latin letters or digits, so words written
+# entirely in Cyrillic or Greek are left alone
+confusable_letters = {
+    # Cyrillic
+    'а': 'a', 'в': 'b', 'е': 'e', 'к': 'k', 'м': 'm', 'н': 'h', 'о': 'o', 'р': 'p',
+    'с': 'c', 'т': 't', 'у': 'y', 'х': 'x', 'і': 'i', 'ј': 'j', 'ѕ': 's', 'ԁ': 'd',
+    'ԛ': 'q', 'ԝ': 'w', 'б': '6', 'з': '3',
+    'А': 'A', 'В': 'B', 'Е': 'E', 'К': 'K', 'М': 'M', 'Н': 'H', 'О': 'O', 'Р': 'P',
+    'С': 'C', 'Т': 'T', 'У': 'Y', 'Х': 'X', 'І': 'I', 'Ј': 'J', 'Ѕ': 'S', 'З': '3',
+    # Greek
+    'α': 'a', 'ε': 'e', 'ι': 'i', 'κ': 'k', 'ν': 'v', 'ο': 'o', 'ρ': 'p', 'τ': 't',
+    'υ': 'u', 'χ': 'x',
+    'Α': 'A', 'Β': 'B', 'Ε': 'E', 'Ζ': 'Z', 'Η': 'H', 'Ι': 'I', 'Κ': 'K', 'Μ': 'M',
+    'Ν': 'N', 'Ο': 'O', 'Ρ': 'P', 'Τ': 'T', 'Υ': 'Y', 'Χ': 'X',
+    # Other letter lookalikes
+    'ı': 'i', 'ȷ': 'j', 'ɡ': 'g', 'ɑ': 'a',
+}
+
+# Lookalike punctuation and invisible characters, folded everywhere in a message
+confusable_chars = {
+    # Dashes, dots and at signs
+    '‐': '-', '‑': '-', '‒': '-', '–': '-', '—': '-', '―': '-', '−': '-',
+    '·': '.', '•': '.', '。': '.',
+    # Invisible characters used to split digits and words
+    '\u00ad': None, '\u200b': None, '\u200c': None, '\u200d': None, '\u2060': None, '\ufeff': None,
+}
+
+def build_normalization_table():
+    """Compile the punctuation confusables and all Unicode decimal digits into one translate table"""
+    table = {}
+    # Decimal digits from every script (Arabic-Indic, Devanagari, ...) to ASCII
+    for codepoint in range(128, sys.maxunicode + 1):
+        value = unicodedata.decimal(chr(codepoint), None)
+        if value is not None:
+            table[codepoint] = str(value)
+    table.update(str.maketrans(confusable_chars))
+    return table
+
+normalization_table = build_normalization_table()
+confusable_letter_table = str.maketrans(confusable_letters)
+
+# Translate tables used by the detectors instead of chains of str.replace
+bracket_translation_table = str.maketrans('', '', '()-')
+substitution_translation_table = str.maketrans({'o': '0', 'i': '1', 'l': '1'})
+separator_translation_table = str.maketrans('', '', ''.join(separator_chars))
+
+# Leetspeak mapping
+leetspeak_map = {
+    '0': ['0', 'o', 'O', '()', '[]', '{}', '<>', 'oh', 'zero'],
+    '1': ['1', 'i', 'I', 'l', 'L', '|', '!', 'one'],
+    '2': ['2', 'z', 'Z', 'to', 'too', 'two'],
+    '3': ['3', 'e', 'E', 'three'],
+    '4': ['4', 'a', 'A', 'four', 'for', '4or'],
+    '5': ['5', 's', 'S', 'five'],
+    '6': ['6', 'G', 'b', 'six'],
+    '7': ['7', 'T', 't', 'seven'],
+    '8': ['8', 'B', 'eight', 'ate'],
+    '9': ['9', 'g', 'nine']
+}
+
+def compile_leetspeak(mapping):
+    """Compile the leetspeak map into multi-character replacements plus one translate table.
+    
+    Variants are applied in map order to lowercased words, so a variant is dead
+    if it has uppercase letters or contains a character an earlier single
+    character variant already replaced.
+    """
+    single_chars = {}
+    replacements = []
+    for digit, variants in mapping.items():
+        for variant in variants:
+            if variant != variant.lower() or variant == digit:
+                continue
+            if any(char in single_chars for char in variant):
+                continue
+            if len(variant) == 1:
+                single_chars[variant] = digit
+            else:
+                replacements.append((variant, digit))
+    return replacements, str.maketrans(single_chars)
+
+leetspeak_replacements, leetspeak_translation_table = compile_leetspeak(leetspeak_map)
+
+def build_caesar_table(rot):
+    """Translate table that shifts ASCII letters by the given ROT value"""
+    lower = 'abcdefghijklmnopqrstuvwxyz'
+    upper = lower.upper()
+    return str.maketrans(lower + upper, lower[rot:] + lower[:rot] + upper[rot:] + upper[:rot])
+
+# Common ROT values tried by the caesar cipher detector
+caesar_translation_tables = {rot: build_caesar_table(rot) for rot in [1, 2, 3, 4, 5, 13, 25]}
+
+def fold_mixed_script_token(match):
+    """Fold lookalike letters in a token that mixes them with Latin letters or digits"""
+    token = match.group()
+    if token.isascii() or not re.search(r'[A-Za-z0-9]', token):
+        return token
+    return token.translate(confusable_letter_table)
+
+def normalize_text(text):
+    """Fold a message to the form the detectors expect (NFKC, confusables and digits to ASCII)"""
+    # Plain ASCII messages are already normalized
+    if text.isascii():
+        return text
+    text = unicodedata.normalize('NFKC', text).translate(normalization_table)
+    return re.sub(r'\S+', fold_mixed_script_token, text)
+
+def get_conversation_id():
+    """Get the identifier of the current conversation"""
+    if 'conversation_id' not in session:
+        session['conversation_id'] = uuid.uuid4().hex
+    return session['conversation_id']
+
 # Add masking configuration
 def get_masking_config():
     """Get the current masking configuration"""
@@ -68,6 +316,30 @@ def get_masking_config():
         session['mask_pii'] = True
     return session['mask_pii']
 
+def default_lexicon():
+    """Compiled number words of the default locales"""
+    return get_number_lexicon(app.config['DEFAULT_LOCALES'])
+
+def get_conversation_locales(message=None):
+    """Number-word locales of the current conversation.
+    
+    The default locales are always included. A locale set explicitly through
+    /locale is added, otherwise any locale guessed from the conversation's
+    messages so far.
+    """
+    if 'locale' in session:
+        extra = session['locale']
+    else:
+        extra = session.get('guessed_locale')
+        guessed = guess_locale(message) if message else None
+        if guessed is not None and extra is None:
+            extra = session['guessed_locale'] = guessed
+    
+    locales = tuple(app.config['DEFAULT_LOCALES'])
+    if extra and extra not in locales:
+        locales += (extra,)
+    return locales
+
 def mask_phone_number(number):
     """Mask a phone number while keeping the last 4 digits visible"""
     if len(number) > 4:
@@ -125,79 +397,117 @@ def has_marketplace_context(text):
     
     return any(re.search(pattern, text_lower) for pattern in patterns)
 
-def normalize_phone_number(text):
+def normalize_phone_number(text, lexicon=None):
     """Convert a string of numbers and words to a potential phone number"""
+    if lexicon is None:
+        lexicon = default_lexicon()
+    
     # Convert the entire string to lowercase for consistent processing
     text = text.lower()
     
-    # First handle simple replacements
-    text = text.replace('(', '').replace(')', '').replace('-', '')
-    
-    # Replace common letter/number substitutions directly
-    text = text.replace('o', '0').replace('O', '0')
-    text = text.replace('i', '1').replace('I', '1').replace('l', '1').replace('L', '1')
+    # Strip brackets and dashes
+    text = text.translate(bracket_translation_table)
     
-    # Split into words
+    # Split into words, alongside the same words with common letter/number substitutions
+    # replaced (substitutions never touch whitespace, so the two lists stay aligned)
     words = text.split()
+    substituted_words = text.translate(substitution_translation_table).split()
     result = ''
     
     # Process each word
-    for word in words:
+    for word, substituted in zip(words, substituted_words):
         # Case 1: Word is already a digit
-        if word.isdigit():
-            result += word
+        if substituted.isdigit():
+            result += substituted
             continue
             
-        # Case 2: Word is a number word
-        if word in number_words:
-            result += number_words[word]
+        # Case 2: Word is a number word (looked up before substitutions turn "two" into "tw0")
+        if word in lexicon.words:
+            result += lexicon.words[word]
             continue
             
         # Case 3: Word contains digits mixed with letters
-        has_digits = any(char.isdigit() for char in word)
+        has_digits = any(char.isdigit() for char in substituted)
         if has_digits:
             # Extract digits
-            result += ''.join(char for char in word if char.isdigit())
+            result += ''.join(char for char in substituted if char.isdigit())
             continue
             
-        # Case 4: Try to match word to number_words even with fuzzy matching
-        closest_match = None
-        for num_word in number_words:
-            if num_word in word or word in num_word:
-                closest_match = num_word
-                break
-                
-        if closest_match:
-            result += number_words[closest_match]
-            continue
+        # Case 4: Match the first number word containing the word or contained in it
+        result += lexicon.matches[substituted]
     
     return result
 
 def is_valid_phone_number(number_str):
     """Check if a string of numbers could be a phone number"""
-    # Remove all non-digits
-    digits = ''.join(filter(str.isdigit, number_str))
-    
-    # Check for common phone number patterns
-    if len(digits) >= 10 and len(digits) <= 11:
-        # Check if it starts with a valid area code
-        if digits.startswith(('1', '2', '3', '4', '5', '6', '7', '8', '9')):
-            return True
-        # Check if it's a valid international format
-        if digits.startswith('1') and len(digits) == 11:
-            return True
-        # Check for common area code patterns
-        if len(digits) == 10 and digits[:3] in ['800', '888', '877', '866', '855', '844', '833', '822', '811']:
-            return True
-        # Check for common US area codes
-        if len(digits) == 10:
-            return True
-    return False
+    country, _ = classify_phone_number(number_str)
+    return country is not None
+
+def classify_phone_number(number_str):
+    """Classify a digit string as a phone number, returning (country, confidence).
+    
+    Returns (None, 0.0) when the digits cannot be a phone number. Only numbers
+    written with a leading + or 00 are checked against the country codes; any
+    other digit string can only be a US/Canada number. Lookups walk the
+    precompiled tables one digit at a time without building substrings.
+    """
+    digits = number_str
+    international = False
+    if not (digits.isascii() and digits.isdigit()):
+        international = number_str.lstrip().startswith('+')
+        # Remove all non-digits
+        digits = ''.join(filter(str.isdigit, number_str))
+        if not digits.isascii():
+            return None, 0.0
+    length = len(digits)
+    
+    # International dial-out prefix: a country code always follows
+    if digits.startswith('00'):
+        digits = digits[2:]
+        length -= 2
+        international = True
+    
+    # NANP number without the country code, or with the leading 1
+    if (length == 10 and not international) or (length == 11 and digits[0] == '1'):
+        country, confidence = classify_nanp_number(digits, length - 10)
+        if country is not None:
+            return country, confidence
+    if not international:
+        return None, 0.0
+    
+    # Other countries: walk the country code trie, then check the national number length
+    if length > 15:
+        return None, 0.0
+    node = 0
+    for position in range(min(length, 3)):
+        node = country_code_trie[node * 10 + ord(digits[position]) - 48]
+        if node < 0:
+            return None, 0.0
+        index = country_code_terminal[node]
+        if index >= 0:
+            code, country = country_code_entries[index]
+            if code != '+1' and length - position - 1 in national_number_lengths[code]:
+                return country, 0.8
+            return None, 0.0
+    return None, 0.0
+
+def classify_nanp_number(digits, start):
+    """Check the area code and exchange of a 10 digit NANP number starting at `start`"""
+    area_code = (ord(digits[start]) - 48) * 100 + (ord(digits[start + 1]) - 48) * 10 + ord(digits[start + 2]) - 48
+    exchange = (ord(digits[start + 3]) - 48) * 100 + (ord(digits[start + 4]) - 48) * 10 + ord(digits[start + 5]) - 48
+    if not nanp_area_codes[area_code] or not nanp_exchanges[exchange]:
+        return None, 0.0
+    if nanp_area_codes[area_code] == NANP_TOLL_FREE:
+        return 'US/Canada', 0.95
+    return 'US/Canada', 0.9
 
-def detect_phone_numbers(text):
+def detect_phone_numbers(text, lexicon=None):
     """Detect phone numbers in text including obfuscated ones"""
+    if lexicon is None:
+        lexicon = default_lexicon()
+    
     # First try to detect a complete phone number in the entire text
-    full_text_normalized = normalize_phone_number(text)
+    full_text_normalized = normalize_phone_number(text, lexicon)
     if is_valid_phone_number(full_text_normalized):
         return [full_text_normalized]
     
@@ -209,14 +519,17 @@ def detect_phone_numbers(text):
     for i in range(len(words)):
         for j in range(i+1, min(i+10, len(words)+1)):  # Look at groups of up to 10 words
             group = ' '.join(words[i:j])
-            normalized = normalize_phone_number(group)
+            normalized = normalize_phone_number(group, lexicon)
             if is_valid_phone_number(normalized) and normalized not in all_numbers:
                 all_numbers.append(normalized)
     
     return all_numbers
 
-def detect_partial_phone_numbers(text):
+def detect_partial_phone_numbers(text, lexicon=None):
     """Detect potential partial phone numbers"""
+    if lexicon is None:
+        lexicon = default_lexicon()
+    
     # Get numbers and digit sequences
     words = text.split()
     number_groups = []
@@ -224,7 +537,7 @@ def detect_partial_phone_numbers(text):
     
     for word in words:
         # If the word contains any digits or number words
-        if any(char.isdigit() for char in word) or word.lower() in number_words or word.lower() in ['o', 'i', 'l']:
+        if any(char.isdigit() for char in word) or word.lower() in lexicon.words or word.lower() in ['o', 'i', 'l']:
             current_group.append(word)
         else:
             if current_group:
@@ -238,7 +551,7 @@ def detect_partial_phone_numbers(text):
     # Process each group
     partial_numbers = []
     for group in number_groups:
-        normalized = normalize_phone_number(group)
+        normalized = normalize_phone_number(group, lexicon)
         # Consider sequences of at least 3 digits as potential partial numbers
         if len(normalized) >= 3 and normalized.isdigit() and not is_valid_phone_number(normalized):
             partial_numbers.append(normalized)
@@ -329,8 +642,11 @@ def detect_partial_email(text):
     
     return partial_elements
 
-def detect_vertical_numbers(text):
+def detect_vertical_numbers(text, lexicon=None):
     """Detect phone numbers that are written vertically (one digit per line)"""
+    if lexicon is None:
+        lexicon = default_lexicon()
+    
     lines = text.split('\n')
     if len(lines) < 7:  # Need at least 7 lines for a partial phone number
         return []
@@ -342,8 +658,8 @@ def detect_vertical_numbers(text):
         # Check if the line contains a single number or number word
         if line.isdigit() and len(line) == 1:
             vertical_digits += line
-        elif line.lower() in number_words:
-            vertical_digits += number_words[line.lower()]
+        elif line.lower() in lexicon.words:
+            vertical_digits += lexicon.words[line.lower()]
         elif line.lower() in ['o', 'oh']:
             vertical_digits += '0'
         elif line.lower() in ['i', 'l']:
@@ -363,16 +679,16 @@ def detect_international_formats(text):
         # (0XX) format (European)
         r'\(0\d{1,2}\)[\s\.\-]?\d{3,4}[\s\.\-]?\d{3,4}',
         # 00XX format (international dial out)
-        r'00\d{1,3}[\s\.\-]?\d{3,4}[\s\.\-]?\d{3,4}'
+        r'00\d{1,3}(?:[\s\.\-]?\d{2,4}){2,3}'
     ]
     
     found_numbers = []
     for pattern in patterns:
         matches = re.findall(pattern, text)
         for match in matches:
-            # Clean up the number
+            # Clean up the number, keeping the + that marks it as international
             cleaned = ''.join(filter(lambda x: x.isdigit() or x == '+', match))
-            if is_valid_phone_number(cleaned.replace('+', '')):
+            if is_valid_phone_number(cleaned):
                 found_numbers.append(cleaned)
     
     return found_numbers
@@ -448,54 +764,33 @@ def detect_social_media_handles(text):
     
     return handles
 
-def detect_leetspeak_numbers(text):
+def detect_leetspeak_numbers(text, lexicon=None):
     """Detect phone numbers written in leetspeak (e.g., 5!x 0n3 f0ur)"""
-    # Leetspeak mapping
-    leetspeak_map = {
-        '0': ['0', 'o', 'O', '()', '[]', '{}', '<>', 'oh', 'zero'],
-        '1': ['1', 'i', 'I', 'l', 'L', '|', '!', 'one'],
-        '2': ['2', 'z', 'Z', 'to', 'too', 'two'],
-        '3': ['3', 'e', 'E', 'three'],
-        '4': ['4', 'a', 'A', 'four', 'for', '4or'],
-        '5': ['5', 's', 'S', 'five'],
-        '6': ['6', 'G', 'b', 'six'],
-        '7': ['7', 'T', 't', 'seven'],
-        '8': ['8', 'B', 'eight', 'ate'],
-        '9': ['9', 'g', 'nine']
-    }
-    
-    # First normalize common leetspeak
+    return detect_phone_numbers(decode_leetspeak(text), lexicon)
+
+def decode_leetspeak(text):
+    """Replace common leetspeak variants with the digits they stand for"""
     words = text.lower().split()
     normalized_words = []
     
     for word in words:
         # Try to convert leetspeak to normal digits
-        for digit, variants in leetspeak_map.items():
-            for variant in variants:
-                word = word.replace(variant, digit)
-        normalized_words.append(word)
+        for variant, digit in leetspeak_replacements:
+            word = word.replace(variant, digit)
+        normalized_words.append(word.translate(leetspeak_translation_table))
     
-    # Join and check for phone numbers
-    normalized_text = ' '.join(normalized_words)
-    return detect_phone_numbers(normalized_text)
+    return ' '.join(normalized_words)
 
-def detect_caesar_cipher(text):
+def detect_caesar_cipher(text, lexicon=None):
     """Detect numbers hidden with simple caesar ciphers"""
     # Try common ROT values
     potential_numbers = []
     
-    for rot in [1, 2, 3, 4, 5, 13, 25]:
-        decoded = ""
-        for char in text:
-            if char.isalpha():
-                ascii_offset = ord('a') if char.islower() else ord('A')
-                shifted = (ord(char) - ascii_offset + rot) % 26 + ascii_offset
-                decoded += chr(shifted)
-            else:
-                decoded += char
+    for table in caesar_translation_tables.values():
+        decoded = text.translate(table)
         
         # Check if the decoded text contains phone numbers
-        found_numbers = detect_phone_numbers(decoded)
+        found_numbers = detect_phone_numbers(decoded, lexicon)
         potential_numbers.extend(found_numbers)
     
     return potential_numbers
@@ -544,9 +839,7 @@ def detect_code_patterns(text):
 def detect_spacing_tricks(text):
     """Detect when spaces or special characters are used to obfuscate numbers"""
     # Remove various separators that might be inserted between digits
-    cleaned_text = text
-    for sep in separator_chars:
-        cleaned_text = cleaned_text.replace(sep, '')
+    cleaned_text = text.translate(separator_translation_table)
     
     # Check for runs of digits in the cleaned text
     digit_runs = re.findall(r'\d{7,}', cleaned_text)
@@ -598,90 +891,442 @@ def detect_first_last_chars(text):
     
     return potential_numbers
 
-def preprocess_message(message):
+def preprocess_message(message, include_deep=True, lexicon=None):
     """Preprocess message to detect potential contact information"""
+    return combine_detector_results(detect_by_detector(message, include_deep, lexicon=lexicon))
+
+def detect_by_detector(message, include_deep=True, names=None, lexicon=None):
+    """Run the detectors (or only the named ones) over a message, keeping the results of each detector separate"""
+    # Normalize once so every detector reads the same folded text
+    message = normalize_text(message)
+    if lexicon is None:
+        lexicon = default_lexicon()
+    
+    # Very long messages are scanned in parallel chunks
+    if len(message) > app.config['CHUNK_SCAN_THRESHOLD']:
+        if names is None:
+            names = [name for name in detector_functions if include_deep or name not in deep_detectors]
+        
+        # A line can hold any number of words, so the line-based detectors see the whole message
+        chunked = [name for name in names if name not in line_detectors]
+        results = merge_chunk_results(scan_chunks(run_detectors, message, chunked, lexicon)) if chunked else {}
+        results.update(run_detectors(message, [name for name in names if name in line_detectors], lexicon))
+        return {name: results[name] for name in names}
+    
+    if names is not None:
+        return run_detectors(message, names, lexicon)
+    return scan_message(message, include_deep, lexicon)
+
+def scan_message(message, include_deep=True, lexicon=None):
+    """Run the detectors over a normalized message, returning results by detector name"""
+    results = {}
+    
     # Original detection methods
-    phone_numbers, partial_numbers, has_email, email, partial_email_elements = detect_basic_patterns(message)
+    results['detect_phone_numbers'] = detect_phone_numbers(message, lexicon)
+    results['detect_partial_phone_numbers'] = detect_partial_phone_numbers(message, lexicon)
+    results['detect_email'] = detect_email(message)
+    results['detect_partial_email'] = detect_partial_email(message)
     
     # Add new detection methods
     # 1. Vertical numbers
-    phone_numbers.extend(detect_vertical_numbers(message))
+    results['detect_vertical_numbers'] = detect_vertical_numbers(message, lexicon)
     
     # 2. International formats
-    phone_numbers.extend(detect_international_formats(message))
+    results['detect_international_formats'] = detect_international_formats(message)
     
-    # 3. ASCII art numbers
-    phone_numbers.extend(detect_ascii_art_numbers(message))
+    # 3. Social media handles
+    results['detect_social_media_handles'] = detect_social_media_handles(message)
     
-    # 4. Social media handles
-    social_handles = detect_social_media_handles(message)
-    # Store social handles as partial email elements
-    for handle in social_handles:
-        partial_email_elements.append({"type": "social_handle", "text": handle.strip()})
+    # 4. Code patterns
+    results['detect_code_patterns'] = detect_code_patterns(message)
+    
+    # 5. Spacing tricks
+    results['detect_spacing_tricks'] = detect_spacing_tricks(message)
+    
+    # 6. Reverse numbers
+    results['detect_reverse_numbers'] = detect_reverse_numbers(message)
     
-    # 5. Leetspeak numbers
-    phone_numbers.extend(detect_leetspeak_numbers(message))
+    # 7. First/last chars of lines
+    results['detect_first_last_chars'] = detect_first_last_chars(message)
+    
+    # 8. Expensive detectors (skipped when they are deferred to the background pool)
+    if include_deep:
+        results.update(detect_deep_patterns(message, lexicon))
+    
+    return results
+
+def detect_deep_patterns(message, lexicon=None):
+    """Run the expensive phone number detectors, returning results by detector name"""
+    results = {}
     
-    # 6. Caesar cipher
-    phone_numbers.extend(detect_caesar_cipher(message))
+    # ASCII art numbers
+    results['detect_ascii_art_numbers'] = detect_ascii_art_numbers(message)
     
-    # 7. Code patterns
-    phone_numbers.extend(detect_code_patterns(message))
+    # Leetspeak numbers
+    results['detect_leetspeak_numbers'] = detect_leetspeak_numbers(message, lexicon)
     
-    # 8. Spacing tricks
-    phone_numbers.extend(detect_spacing_tricks(message))
+    # Caesar cipher
+    results['detect_caesar_cipher'] = detect_caesar_cipher(message, lexicon)
+    
+    return results
+
+# Detectors whose results are phone numbers
+phone_number_detectors = [
+    'detect_phone_numbers', 'detect_vertical_numbers', 'detect_international_formats',
+    'detect_code_patterns', 'detect_spacing_tricks', 'detect_reverse_numbers',
+    'detect_first_last_chars', 'detect_ascii_art_numbers', 'detect_leetspeak_numbers',
+    'detect_caesar_cipher'
+]
+
+# Detectors deferred to the background pool in async mode
+deep_detectors = ['detect_ascii_art_numbers', 'detect_leetspeak_numbers', 'detect_caesar_cipher']
+
+# Detectors that read whole lines, which chunking by words could cut apart
+line_detectors = ['detect_vertical_numbers', 'detect_first_last_chars', 'detect_ascii_art_numbers']
+
+# Every detector by name, for re-running them one at a time
+detector_functions = {
+    'detect_phone_numbers': detect_phone_numbers,
+    'detect_partial_phone_numbers': detect_partial_phone_numbers,
+    'detect_email': detect_email,
+    'detect_partial_email': detect_partial_email,
+    'detect_vertical_numbers': detect_vertical_numbers,
+    'detect_international_formats': detect_international_formats,
+    'detect_social_media_handles': detect_social_media_handles,
+    'detect_code_patterns': detect_code_patterns,
+    'detect_spacing_tricks': detect_spacing_tricks,
+    'detect_reverse_numbers': detect_reverse_numbers,
+    'detect_first_last_chars': detect_first_last_chars,
+    'detect_ascii_art_numbers': detect_ascii_art_numbers,
+    'detect_leetspeak_numbers': detect_leetspeak_numbers,
+    'detect_caesar_cipher': detect_caesar_cipher
+}
+
+# Detectors that look words up in the number-word lexicon
+number_word_detectors = {
+    'detect_phone_numbers', 'detect_partial_phone_numbers', 'detect_vertical_numbers',
+    'detect_leetspeak_numbers', 'detect_caesar_cipher'
+}
+
+def run_detectors(message, names, lexicon=None):
+    """Run the named detectors over a normalized message, returning results by detector name"""
+    results = {}
+    for name in names:
+        if name in number_word_detectors:
+            results[name] = detector_functions[name](message, lexicon)
+        else:
+            results[name] = detector_functions[name](message)
+    return results
+
+# Version of every detector's rules. Bump a detector's version when its logic
+# changes so stored results from the old version are re-evaluated.
+detector_versions = {
+    'detect_phone_numbers': 5,
+    'detect_partial_phone_numbers': 5,
+    'detect_email': 2,
+    'detect_partial_email': 2,
+    'detect_vertical_numbers': 4,
+    'detect_international_formats': 4,
+    'detect_social_media_handles': 2,
+    'detect_code_patterns': 4,
+    'detect_spacing_tricks': 4,
+    'detect_reverse_numbers': 4,
+    'detect_first_last_chars': 4,
+    'detect_ascii_art_numbers': 4,
+    'detect_leetspeak_numbers': 5,
+    'detect_caesar_cipher': 5,
+    'check_cross_message_pii': 5
+}
+
+# Lexicons each detector looks words up in. Lexicon changes are versioned
+# automatically from their contents, so they need no version bump.
+detector_lexicons = {
+    'detect_phone_numbers': ['number_words'],
+    'detect_partial_phone_numbers': ['number_words'],
+    'detect_vertical_numbers': ['number_words'],
+    'detect_leetspeak_numbers': ['leetspeak_map', 'number_words'],
+    'detect_caesar_cipher': ['number_words'],
+    'check_cross_message_pii': ['number_words']
+}
+
+def lexicon_snapshot(name):
+    """Contents of a lexicon as an ordered word -> value mapping"""
+    if name == 'number_words':
+        return number_words_snapshot()
+    if name == 'leetspeak_map':
+        return {variant: digit for digit, variants in leetspeak_map.items() for variant in variants}
+    return {phrase: '' for phrase in sorted(marketplace_context)}
+
+def lexicon_fingerprint(snapshot):
+    """Short content hash identifying a lexicon version"""
+    serialized = json.dumps(list(snapshot.items()), ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()[:12]
+
+def read_snapshot_file(path):
+    """Lexicon snapshots and rule stamps recorded in the snapshot file"""
+    if not path or not os.path.exists(path):
+        return {}, {}
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    # Older files only hold lexicon snapshots
+    if 'lexicons' not in data:
+        return data, {}
+    return data['lexicons'], data.get('rules', {})
+
+def save_snapshot_file(path):
+    """Merge the lexicon snapshots and rule stamps of this worker into the snapshot file"""
+    with snapshot_file_lock:
+        snapshots, stamps = read_snapshot_file(path)
+        snapshots.update(lexicon_snapshots)
+        stamps.update(rule_stamps)
+        # Write through a temporary file so other workers never read a partial file
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'lexicons': snapshots, 'rules': stamps}, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+def load_lexicon_snapshots(path):
+    """Known lexicon versions by fingerprint, including the current ones"""
+    snapshots, stamps = read_snapshot_file(path)
+    rule_stamps.update(stamps)
+    
+    for name in lexicon_names:
+        snapshot = lexicon_snapshot(name)
+        fingerprint = lexicon_fingerprint(snapshot)
+        snapshots.setdefault(fingerprint, snapshot)
+        lexicon_versions[name] = fingerprint
+    return snapshots
+
+# Detector and lexicon versions stored messages were evaluated with, by fingerprint.
+# Messages only keep the fingerprint, so the tables are not repeated in every message.
+rule_stamps = {}
+snapshot_file_lock = threading.Lock()
+
+# Current lexicon versions and the contents of every version seen so far
+lexicon_names = ['number_words', 'leetspeak_map', 'marketplace_context']
+lexicon_versions = {}
+# New lexicon versions reach the snapshot file with the first rule fingerprint that uses them
+lexicon_snapshots = load_lexicon_snapshots(app.config['LEXICON_SNAPSHOTS'])
+
+def combine_detector_results(results):
+    """Combine results by detector into (phone numbers, partial numbers, has email, email, partial email elements)"""
+    phone_numbers = []
+    for name in phone_number_detectors:
+        phone_numbers.extend(results.get(name, []))
     
-    # 9. Reverse numbers
-    phone_numbers.extend(detect_reverse_numbers(message))
+    has_email, email = results.get('detect_email', (False, None))
     
-    # 10. First/last chars of lines
-    phone_numbers.extend(detect_first_last_chars(message))
+    # Store social handles as partial email elements
+    partial_email_elements = list(results.get('detect_partial_email', []))
+    for handle in results.get('detect_social_media_handles', []):
+        partial_email_elements.append({"type": "social_handle", "text": handle.strip()})
     
     # Remove duplicates
     unique_phone_numbers = list(set(phone_numbers))
     
-    return unique_phone_numbers, partial_numbers, has_email, email, partial_email_elements
+    return unique_phone_numbers, list(results.get('detect_partial_phone_numbers', [])), has_email, email, partial_email_elements
 
-def detect_basic_patterns(message):
-    """Original pattern detection functionality"""
-    # Detect phone numbers
-    phone_numbers = detect_phone_numbers(message)
-    
-    # Detect partial phone numbers
-    partial_numbers = detect_partial_phone_numbers(message)
+# Longest span in words an obfuscated contact can cover in the detectors that are
+# run per chunk: the phone number window is 9 words, with room for separators
+# written as words of their own. The line-based detectors are not chunked.
+max_contact_span_words = 16
+
+def split_into_chunks(text, chunk_size, overlap_words=max_contact_span_words):
+    """Split text at word boundaries into chunks that overlap by the longest contact span.
+    
+    Returns (offset, chunk) pairs so results can be ordered by their position.
+    """
+    words = [match.span() for match in re.finditer(r'\S+', text)]
+    chunks = []
+    start = 0
+    while start < len(words):
+        end = start
+        # Grow the chunk word by word until it reaches the target size
+        while end < len(words) and words[end][1] - words[start][0] <= chunk_size:
+            end += 1
+        end = max(end, start + 1)
+        chunks.append((words[start][0], text[words[start][0]:words[end - 1][1]]))
+        if end >= len(words):
+            break
+        start = max(start + 1, end - overlap_words)
+    return chunks
+
+# Process pool for scanning chunks of very long messages, and the process that created it
+chunk_scan_pool = None
+chunk_scan_pool_pid = None
+chunk_scan_lock = threading.Lock()
+
+def get_chunk_scan_pool():
+    """Create this process's chunk scanning pool on first use.
+    
+    Workers are started by a fork server rather than forked from this process,
+    which may already be running threads. A pool inherited from the master of a
+    pre-fork server has no manager thread in this process, so each process
+    creates its own.
+    """
+    global chunk_scan_pool, chunk_scan_pool_pid
+    with chunk_scan_lock:
+        if chunk_scan_pool is None or chunk_scan_pool_pid != os.getpid():
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            chunk_scan_pool = ProcessPoolExecutor(max_workers=app.config['CHUNK_SCAN_WORKERS'],
+                                                  mp_context=multiprocessing.get_context(method))
+            chunk_scan_pool_pid = os.getpid()
+        return chunk_scan_pool
+
+def finding_key(item):
+    """What makes two findings of a detector the same finding"""
+    return (item.get('type'), item.get('text')) if isinstance(item, dict) else item.strip()
+
+def scan_chunk(function, chunk, overlap, *args):
+    """Apply a detector function to a chunk, leaving out the findings the previous chunk already has.
+    
+    The first `overlap` characters of the chunk were also scanned at the end of
+    the previous chunk. Findings that lie entirely inside them are dropped here,
+    once each, so a number repeated elsewhere in the chunk is still kept.
+    """
+    results = function(chunk, *args)
+    if not overlap:
+        return results
+    
+    for name, value in function(chunk[:overlap], *args).items():
+        if name == 'detect_email' or not value:
+            continue
+        repeated = {}
+        for item in value:
+            key = finding_key(item)
+            repeated[key] = repeated.get(key, 0) + 1
+        kept = []
+        for item in results.get(name, []):
+            key = finding_key(item)
+            if repeated.get(key):
+                repeated[key] -= 1
+            else:
+                kept.append(item)
+        results[name] = kept
+    return results
+
+def scan_chunks(function, message, *args):
+    """Apply a detector function to every chunk of a long message, in parallel where possible"""
+    global chunk_scan_pool
+    chunks = split_into_chunks(message, app.config['CHUNK_SCAN_SIZE'])
+    offsets = [offset for offset, _ in chunks]
+    texts = [chunk for _, chunk in chunks]
+    # Characters each chunk shares with the end of the chunk before it
+    overlaps = [0] + [max(0, offsets[index - 1] + len(texts[index - 1]) - offsets[index])
+                      for index in range(1, len(chunks))]
+    functions = [function] * len(texts)
+    extra_args = [[arg] * len(texts) for arg in args]
+    
+    if app.config['CHUNK_SCAN_WORKERS'] > 1 and len(texts) > 1:
+        try:
+            return list(zip(offsets, get_chunk_scan_pool().map(scan_chunk, functions, texts, overlaps, *extra_args)))
+        except BrokenProcessPool:
+            # A worker died, start a fresh pool next time and finish this message serially
+            app.logger.exception('Chunk scan pool failed, scanning serially')
+            with chunk_scan_lock:
+                chunk_scan_pool = None
+    
+    return list(zip(offsets, map(scan_chunk, functions, texts, overlaps, *extra_args)))
+
+def merge_chunk_results(chunk_results):
+    """Merge per-chunk results by detector in offset order, keeping the first email found"""
+    merged = {}
+    
+    for _, results in sorted(chunk_results, key=lambda item: item[0]):
+        for name, value in results.items():
+            # detect_email reports one (found, email) pair, keep the first email found
+            if name == 'detect_email':
+                if name not in merged or (value[0] and not merged[name][0]):
+                    merged[name] = value
+                continue
+            merged.setdefault(name, []).extend(value)
     
-    # Check for emails
-    has_email, email = detect_email(message)
+    return merged
+
+def history_entry(msg):
+    """Detection state the cross-message checks need from a stored message"""
+    partial_info = msg.get('partial_info', {})
+    pii_details = msg.get('pii_details', [])
+    return {
+        'id': msg.get('id'),
+        'detail_count': len(pii_details),
+        'revision': msg.get('revision', 0),
+        'text': normalize_text(msg.get('text', '')),
+        'phone_numbers': [detail.get('text', '') for detail in pii_details if detail.get('type') == 'PHONE_NUMBER'],
+        'partial_numbers': partial_info.get('partial_numbers', []),
+        'partial_email_elements': partial_info.get('partial_email_elements', [])
+    }
+
+def get_history_entries(conversation_id, recent_history):
+    """Recent history as cached detection state, rebuilding only missing or stale entries"""
+    if conversation_cache is None or conversation_id is None:
+        return [history_entry(msg) for msg in recent_history]
     
-    # Detect partial email elements
-    partial_email_elements = detect_partial_email(message)
+    state = conversation_cache.get(conversation_id)
+    cached = {entry['id']: entry for entry in state['entries']} if state else {}
     
-    return phone_numbers, partial_numbers, has_email, email, partial_email_elements
+    entries = []
+    rebuilt = False
+    for msg in recent_history:
+        entry = cached.get(msg.get('id')) if msg.get('id') else None
+        # Deep detection results and re-evaluation change the stored details
+        if (entry is None or entry['detail_count'] != len(msg.get('pii_details', []))
+                or entry.get('revision', 0) != msg.get('revision', 0)):
+            entry = history_entry(msg)
+            rebuilt = True
+        entries.append(entry)
+    
+    if rebuilt:
+        # Refresh the rebuilt entries in place, keeping the rest of the cached history
+        refreshed = {entry['id']: entry for entry in entries if entry['id']}
+        merged = [refreshed.pop(entry['id'], entry) for entry in state['entries']] if state else []
+        merged.extend(refreshed.values())
+        conversation_cache.put(conversation_id, {'entries': merged[-app.config['CONVERSATION_CACHE_HISTORY']:]})
+    return entries
+
+def remember_message(conversation_id, stored_message):
+    """Add a newly stored message to the cached state of its conversation"""
+    if conversation_cache is None:
+        return
+    state = conversation_cache.get(conversation_id)
+    entries = (state['entries'] if state else []) + [history_entry(stored_message)]
+    conversation_cache.put(conversation_id, {'entries': entries[-app.config['CONVERSATION_CACHE_HISTORY']:]})
 
-def check_cross_message_pii(current_message, message_history, max_history=3):
+def check_cross_message_pii(current_message, message_history, max_history=3, should_mask=None,
+                            conversation_id=None, current_results=None, lexicon=None):
     """Check for PII spread across multiple messages with enhanced detection"""
     if not message_history or len(message_history) == 0:
         return [], False, None
     
-    # Get partial elements from current message
-    current_numbers, partial_numbers, _, _, partial_email_elements = preprocess_message(current_message)
+    # Background workers have no request context, so they pass the masking setting in
+    if should_mask is None:
+        should_mask = get_masking_config()
+    
+    # Get partial elements from current message, reusing the caller's detection results if given
+    current_message = normalize_text(current_message)
+    if current_results is None:
+        current_results = preprocess_message(current_message, lexicon=lexicon)
+    current_numbers, partial_numbers, _, _, partial_email_elements = current_results
     
     cross_message_pii = []
     
     # Only check the last N messages for performance
     recent_history = message_history[-max_history:] if len(message_history) > max_history else message_history
     
-    # Convert recent history to text messages only
-    recent_messages = [msg.get('text', '') for msg in recent_history]
+    # Extracted state of the recent history, from the conversation cache when possible
+    recent_entries = get_history_entries(conversation_id, recent_history)
+    
+    # Convert recent history to normalized text messages only
+    recent_messages = [entry['text'] for entry in recent_entries]
     
     # STEP 1: First try to detect a complete number by joining ALL messages
     # This handles split numbers like "9o3 seven O 3 eight 88" + "5"
     combined_text = ' '.join(recent_messages + [current_message])
-    combined_phone_numbers = detect_phone_numbers(combined_text)
+    combined_phone_numbers = detect_phone_numbers(combined_text, lexicon)
     
     # Also check for vertical patterns across messages
     stacked_text = '\n'.join(recent_messages + [current_message])
-    vertical_numbers = detect_vertical_numbers(stacked_text)
+    vertical_numbers = detect_vertical_numbers(stacked_text, lexicon)
     combined_phone_numbers.extend(vertical_numbers)
     
     # Check for first/last character patterns across messages
@@ -690,11 +1335,8 @@ def check_cross_message_pii(current_message, message_history, max_history=3):
     
     # Get all previously detected numbers
     individual_numbers = []
-    for msg in recent_history:
-        pii_details = msg.get('pii_details', [])
-        for detail in pii_details:
-            if detail.get('type') == 'PHONE_NUMBER':
-                individual_numbers.append(detail.get('text'))
+    for entry in recent_entries:
+        individual_numbers.extend(entry['phone_numbers'])
     
     # Add current message detected numbers
     individual_numbers.extend(current_numbers)
@@ -705,7 +1347,7 @@ def check_cross_message_pii(current_message, message_history, max_history=3):
             cross_message_pii.append({
                 'type': 'PHONE_NUMBER',
                 'text': number,
-                'display_text': mask_phone_number(number) if get_masking_config() else number,
+                'display_text': mask_phone_number(number) if should_mask else number,
                 'score': 0.9,
                 'is_cross_message': True
             })
@@ -715,10 +1357,8 @@ def check_cross_message_pii(current_message, message_history, max_history=3):
     
     # Get partial numbers from previous messages
     all_partials = []
-    for msg in recent_history:
-        partial_info = msg.get('partial_info', {})
-        parts = partial_info.get('partial_numbers', [])
-        all_partials.extend(parts)
+    for entry in recent_entries:
+        all_partials.extend(entry['partial_numbers'])
     
     # Add partial numbers from current message
     all_partials.extend(partial_numbers)
@@ -735,7 +1375,7 @@ def check_cross_message_pii(current_message, message_history, max_history=3):
                     cross_message_pii.append({
                         'type': 'PHONE_NUMBER',
                         'text': combined,
-                        'display_text': mask_phone_number(combined) if get_masking_config() else combined,
+                        'display_text': mask_phone_number(combined) if should_mask else combined,
                         'score': 0.9,
                         'is_cross_message': True
                     })
@@ -748,7 +1388,7 @@ def check_cross_message_pii(current_message, message_history, max_history=3):
                             cross_message_pii.append({
                                 'type': 'PHONE_NUMBER',
                                 'text': three_combined,
-                                'display_text': mask_phone_number(three_combined) if get_masking_config() else three_combined,
+                                'display_text': mask_phone_number(three_combined) if should_mask else three_combined,
                                 'score': 0.9,
                                 'is_cross_message': True
                             })
@@ -757,43 +1397,37 @@ def check_cross_message_pii(current_message, message_history, max_history=3):
     # This handles cases like "90370388" + "5"
     
     # Get all detected numbers from previous messages that might be almost complete
-    for msg in recent_history:
-        pii_details = msg.get('pii_details', [])
-        for detail in pii_details:
-            if detail.get('type') == 'PHONE_NUMBER':
-                prev_number = detail.get('text', '')
-                
-                # If previous number was 9 digits and current message contains a single digit
-                if len(prev_number) == 9 and current_message.strip().isdigit() and len(current_message.strip()) == 1:
-                    combined = prev_number + current_message.strip()
+    for entry in recent_entries:
+        for prev_number in entry['phone_numbers']:
+            # If previous number was 9 digits and current message contains a single digit
+            if len(prev_number) == 9 and current_message.strip().isdigit() and len(current_message.strip()) == 1:
+                combined = prev_number + current_message.strip()
+                if is_valid_phone_number(combined) and combined not in individual_numbers:
+                    cross_message_pii.append({
+                        'type': 'PHONE_NUMBER',
+                        'text': combined,
+                        'display_text': mask_phone_number(combined) if should_mask else combined,
+                        'score': 0.95,
+                        'is_cross_message': True
+                    })
+            
+            # Try appending any numbers in the current message
+            for word in current_message.split():
+                if word.isdigit() and len(word) <= 2:  # 1 or 2 digits
+                    combined = prev_number + word
                     if is_valid_phone_number(combined) and combined not in individual_numbers:
                         cross_message_pii.append({
                             'type': 'PHONE_NUMBER',
                             'text': combined,
-                            'display_text': mask_phone_number(combined) if get_masking_config() else combined,
+                            'display_text': mask_phone_number(combined) if should_mask else combined,
                             'score': 0.95,
                             'is_cross_message': True
                         })
-                
-                # Try appending any numbers in the current message
-                for word in current_message.split():
-                    if word.isdigit() and len(word) <= 2:  # 1 or 2 digits
-                        combined = prev_number + word
-                        if is_valid_phone_number(combined) and combined not in individual_numbers:
-                            cross_message_pii.append({
-                                'type': 'PHONE_NUMBER',
-                                'text': combined,
-                                'display_text': mask_phone_number(combined) if get_masking_config() else combined,
-                                'score': 0.95,
-                                'is_cross_message': True
-                            })
     
     # STEP 4: Check for social media handles across messages
     all_social_handles = []
-    for msg in recent_history:
-        partial_info = msg.get('partial_info', {})
-        elements = partial_info.get('partial_email_elements', [])
-        for element in elements:
+    for entry in recent_entries:
+        for element in entry['partial_email_elements']:
             if element.get('type') == 'social_handle':
                 all_social_handles.append(element.get('text'))
     
@@ -807,7 +1441,7 @@ def check_cross_message_pii(current_message, message_history, max_history=3):
         cross_message_pii.append({
             'type': 'SOCIAL_MEDIA',
             'text': handle,
-            'display_text': mask_email(handle) if get_masking_config() else handle,
+            'display_text': mask_email(handle) if should_mask else handle,
             'score': 0.9,
             'is_cross_message': True
         })
@@ -821,10 +1455,9 @@ def check_cross_message_pii(current_message, message_history, max_history=3):
     tld_msgs = {}
     username_msgs = {}
     
-    # Map email components to messages
-    for i, msg in enumerate(recent_messages + [current_message]):
-        _, _, _, _, partial_elements = preprocess_message(msg)
-        
+    # Map email components to messages using the elements already extracted from each one
+    message_elements = [entry['partial_email_elements'] for entry in recent_entries] + [partial_email_elements]
+    for i, partial_elements in enumerate(message_elements):
         for element in partial_elements:
             if element.get('type') == 'domain':
                 domain_msgs[element.get('text')] = i
@@ -845,7 +1478,7 @@ def check_cross_message_pii(current_message, message_history, max_history=3):
                     cross_message_pii.append({
                         'type': 'EMAIL_ADDRESS',
                         'text': reconstructed_email,
-                        'display_text': mask_email(reconstructed_email) if get_masking_config() else reconstructed_email,
+                        'display_text': mask_email(reconstructed_email) if should_mask else reconstructed_email,
                         'score': 0.9,
                         'is_cross_message': True
                     })
@@ -860,80 +1493,668 @@ def check_cross_message_pii(current_message, message_history, max_history=3):
     
     return unique_pii, has_cross_email, cross_email
 
+# Background pool and pending results for the deep detection tier
+deep_detection_pool = None
+deep_detection_results = OrderedDict()
+deep_detection_lock = threading.Lock()
+
+def get_deep_detection_pool():
+    """Create the deep detection worker pool on first use"""
+    global deep_detection_pool
+    with deep_detection_lock:
+        if deep_detection_pool is None:
+            deep_detection_pool = ThreadPoolExecutor(
+                max_workers=app.config['DEEP_DETECTION_WORKERS'],
+                thread_name_prefix='deep-detection'
+            )
+    return deep_detection_pool
+
+def run_deep_detection(message, message_history, fast_results, should_mask, conversation_id=None, lexicon=None):
+    """Run the deep detectors and cross-message checks for a stored message"""
+    pii_details = []
+    
+    # Deep phone number detectors, skipping anything the fast path already reported
+    seen_numbers = set(combine_detector_results(fast_results)[0])
+    deep_results = detect_by_detector(message, names=deep_detectors, lexicon=lexicon)
+    deep_numbers = [phone for name in deep_detectors for phone in deep_results[name]]
+    
+    for phone in set(deep_numbers):
+        if phone not in seen_numbers:
+            pii_details.append({
+                'type': 'PHONE_NUMBER',
+                'text': phone,
+                'display_text': mask_phone_number(phone) if should_mask else phone,
+                'score': 0.85
+            })
+    
+    # Cross-message combinators, reusing the fast and deep results instead of running every detector again
+    current_results = combine_detector_results(dict(fast_results, **deep_results))
+    cross_message_pii, _, _ = check_cross_message_pii(message, message_history, should_mask=should_mask,
+                                                      conversation_id=conversation_id, current_results=current_results,
+                                                      lexicon=lexicon)
+    pii_details.extend(cross_message_pii)
+    
+    return {'pii_details': pii_details, 'detector_results': deep_results}
+
+def submit_deep_detection(message_id, message, message_history, fast_results, should_mask, conversation_id=None,
+                          lexicon=None, max_history=3):
+    """Queue the deep detectors for a message that was stored with fast results only"""
+    # The cross-message check only reads the last few messages, so only those are copied
+    future = get_deep_detection_pool().submit(
+        run_deep_detection, message, copy.deepcopy(message_history[-max_history:]), dict(fast_results), should_mask,
+        conversation_id, lexicon
+    )
+    with deep_detection_lock:
+        deep_detection_results[message_id] = future
+        # Drop the oldest entries if clients stop polling for them
+        while len(deep_detection_results) > app.config['DEEP_DETECTION_MAX_PENDING']:
+            deep_detection_results.popitem(last=False)
+
+def resubmit_deep_detection(msg, previous_messages, conversation_id=None):
+    """Queue the deep detectors again for a pending message this process holds no results for.
+    
+    That happens when the request reaches another worker than the one the
+    message was sent to, after a restart, or once the entry was evicted.
+    """
+    lexicon = get_number_lexicon(msg.get('locales') or app.config['DEFAULT_LOCALES'])
+    submit_deep_detection(msg['id'], msg['text'], previous_messages, stored_detector_results(msg),
+                          msg.get('masking_enabled', True), conversation_id, lexicon)
+
+def attach_deep_results(msg, future):
+    """Attach the results of a finished deep detection to a stored message"""
+    try:
+        deep_detection = future.result()
+        msg['pii_details'].extend(deep_detection['pii_details'])
+        store_detector_results(msg, deep_detection['detector_results'])
+        stamp_detectors(msg, ['check_cross_message_pii'])
+        mark_blocklisted(msg)
+    except Exception:
+        app.logger.exception('Deep detection failed for message %s', msg.get('id'))
+    msg['pii_detected'] = len(msg['pii_details']) > 0
+    msg['deep_pending'] = False
+
+def merge_deep_results(messages, conversation_id=None):
+    """Attach finished deep detection results to the stored messages.
+    
+    Pending messages whose results this process does not hold are queued again.
+    """
+    updated = False
+    for i, msg in enumerate(messages):
+        if not msg.get('deep_pending'):
+            continue
+        
+        with deep_detection_lock:
+            future = deep_detection_results.get(msg.get('id'))
+            if future is not None and not future.done():
+                continue
+            deep_detection_results.pop(msg.get('id'), None)
+        
+        if future is None:
+            resubmit_deep_detection(msg, messages[:i], conversation_id)
+            continue
+        attach_deep_results(msg, future)
+        updated = True
+    
+    return updated
+
+# Detectors whose results a stored message already keeps in its partial_info
+partial_info_detectors = ['detect_partial_phone_numbers', 'detect_partial_email', 'detect_social_media_handles']
+
+def store_detector_results(msg, results):
+    """Keep the non-empty results of each detector on a stored message and stamp their versions"""
+    stored = msg.setdefault('detector_results', {})
+    for name, value in results.items():
+        found = value[0] if name == 'detect_email' else value
+        if found and name not in partial_info_detectors:
+            stored[name] = value
+        else:
+            stored.pop(name, None)
+    stamp_detectors(msg, results)
+
+def stored_detector_results(msg):
+    """Results by detector of a stored message, rebuilding the partial ones from its partial_info"""
+    results = dict(msg.get('detector_results', {}))
+    partial_info = msg.get('partial_info', {})
+    elements = partial_info.get('partial_email_elements', [])
+    results['detect_partial_phone_numbers'] = list(partial_info.get('partial_numbers', []))
+    results['detect_partial_email'] = [element for element in elements if element.get('type') != 'social_handle']
+    results['detect_social_media_handles'] = [element['text'] for element in elements
+                                              if element.get('type') == 'social_handle']
+    return results
+
+def register_rules(stamp):
+    """Fingerprint of a set of detector and lexicon versions, recording it on first use"""
+    serialized = json.dumps(stamp, sort_keys=True, separators=(',', ':'))
+    fingerprint = hashlib.sha1(serialized.encode('utf-8')).hexdigest()[:12]
+    if fingerprint not in rule_stamps:
+        rule_stamps[fingerprint] = stamp
+        if app.config['LEXICON_SNAPSHOTS']:
+            save_snapshot_file(app.config['LEXICON_SNAPSHOTS'])
+    return fingerprint
+
+def message_rules(msg):
+    """Detector and lexicon versions a stored message was evaluated with.
+    
+    An unknown fingerprint (recorded by another worker without a shared
+    snapshot file) reads as no versions, so every detector is re-run.
+    """
+    if 'rules' in msg:
+        return rule_stamps.get(msg['rules'], {'detectors': {}, 'lexicons': {}})
+    # Messages stored before stamps were shared carry their own tables
+    return {'detectors': msg.get('detector_versions', {}), 'lexicons': msg.get('lexicon_versions', {})}
+
+def set_message_rules(msg, detectors):
+    """Stamp a stored message with detector versions and the current lexicon versions"""
+    msg['rules'] = register_rules({'detectors': detectors, 'lexicons': dict(lexicon_versions)})
+    msg.pop('detector_versions', None)
+    msg.pop('lexicon_versions', None)
+
+def stamp_detectors(msg, names):
+    """Record the detector and lexicon versions a stored message was evaluated with"""
+    versions = dict(message_rules(msg)['detectors'])
+    for name in names:
+        versions[name] = detector_versions[name]
+    set_message_rules(msg, versions)
+
+# Words added, removed or remapped between two lexicon versions, by (lexicon, old fingerprint)
+lexicon_deltas = {}
+
+def lexicon_delta(name, fingerprint):
+    """Words that differ between a past version of a lexicon and the current one, or None if unknown"""
+    key = (name, fingerprint)
+    if key not in lexicon_deltas:
+        old = lexicon_snapshots.get(fingerprint)
+        new = lexicon_snapshots[lexicon_versions[name]]
+        if old is None:
+            lexicon_deltas[key] = None
+        elif [word for word in old if word in new] != [word for word in new if word in old]:
+            # Words are matched in order, so a reordering can change any match
+            lexicon_deltas[key] = set(old) | set(new)
+        else:
+            lexicon_deltas[key] = {word for word in set(old) | set(new) if old.get(word) != new.get(word)}
+    return lexicon_deltas[key]
+
+def lexicon_change_affects(detector, lexicon, changed_words, text):
+    """Whether changed lexicon words can alter a detector's result on a text"""
+    text = normalize_text(text)
+    
+    # Leetspeak variants are replaced anywhere inside a word
+    if lexicon == 'leetspeak_map':
+        return any(word.lower() in text.lower() for word in changed_words)
+    
+    # Number words are looked up in the text as the detector sees it
+    views = [text]
+    if detector == 'detect_leetspeak_numbers':
+        views.append(decode_leetspeak(text))
+    elif detector == 'detect_caesar_cipher':
+        views.extend(text.translate(table) for table in caesar_translation_tables.values())
+    
+    exact_tokens = set()
+    fuzzy_tokens = set()
+    for view in views:
+        view = view.lower()
+        stripped = view.translate(bracket_translation_table)
+        translated = stripped.translate(substitution_translation_table).split()
+        exact_tokens.update(line.strip() for line in view.split('\n'))
+        exact_tokens.update(view.split())
+        exact_tokens.update(stripped.split())
+        exact_tokens.update(translated)
+        # Words without digits are also matched as substrings in either direction
+        fuzzy_tokens.update(word for word in translated if not any(char.isdigit() for char in word))
+    
+    for word in changed_words:
+        # Number words are keyed by their locale in the snapshots
+        word = word.rpartition(':')[2].lower()
+        if word in exact_tokens or any(word in token or token in word for token in fuzzy_tokens):
+            return True
+    return False
+
+def stale_detectors(msg, previous_messages, max_history=3):
+    """Detectors whose stored results for a message may differ under the current rules"""
+    stamp = message_rules(msg)
+    stamped_versions = stamp['detectors']
+    stamped_lexicons = stamp['lexicons']
+    stale = []
+    
+    for name, version in detector_versions.items():
+        # Detectors that changed, or never ran on this message
+        if stamped_versions.get(name) != version:
+            stale.append(name)
+            continue
+        
+        # Detectors whose lexicons changed in a way that touches this message
+        text = msg.get('text', '')
+        if name == 'check_cross_message_pii':
+            text = '\n'.join([prev.get('text', '') for prev in previous_messages[-max_history:]] + [text])
+        for lexicon in detector_lexicons.get(name, []):
+            fingerprint = stamped_lexicons.get(lexicon)
+            if fingerprint == lexicon_versions[lexicon]:
+                continue
+            changed_words = lexicon_delta(lexicon, fingerprint)
+            if changed_words is None or lexicon_change_affects(name, lexicon, changed_words, text):
+                stale.append(name)
+                break
+    
+    return stale
+
+def reevaluate_message(msg, previous_messages, force=(), defer_deep=False, conversation_id=None):
+    """Re-run only the stale detectors of a stored message.
+    
+    With `defer_deep`, stale deep detectors and cross-message checks are
+    queued on the background pool and the message is marked pending, as a
+    new message is in async mode. Returns the names of the detectors that
+    were re-run or queued, or None if the message was already evaluated with
+    the current versions.
+    """
+    stale = stale_detectors(msg, previous_messages)
+    stale.extend(name for name in force if name not in stale)
+    if not stale:
+        stamp = message_rules(msg)
+        if stamp['lexicons'] == lexicon_versions and 'rules' in msg:
+            return None
+        # Lexicons changed without touching this message, so only restamp it
+        set_message_rules(msg, dict(stamp['detectors']))
+        return []
+    
+    should_mask = msg.get('masking_enabled', True)
+    lexicon = get_number_lexicon(msg.get('locales') or app.config['DEFAULT_LOCALES'])
+    
+    # Deep results are replaced as a whole by the background run (messages stored before ids are re-run inline)
+    deferred = []
+    if defer_deep and 'id' in msg:
+        deferred = [name for name in stale if name in deep_detectors or name == 'check_cross_message_pii']
+    detector_results = stored_detector_results(msg)
+    if deferred:
+        for name in deep_detectors:
+            detector_results.pop(name, None)
+            msg.get('detector_results', {}).pop(name, None)
+    
+    # Re-run the stale detectors and combine them with the stored results of the rest
+    detectors = [name for name in stale if name in detector_functions and name not in deferred]
+    if detectors:
+        rerun = detect_by_detector(msg['text'], names=detectors, lexicon=lexicon)
+        detector_results.update(rerun)
+        store_detector_results(msg, rerun)
+    results = combine_detector_results(detector_results)
+    phone_numbers, partial_numbers, has_email, email, partial_email_elements = results
+    msg['partial_info'] = {
+        'partial_numbers': partial_numbers,
+        'partial_email_elements': partial_email_elements
+    }
+    
+    # Cross-message results are kept unless the combinators themselves are stale
+    if deferred:
+        cross_message_pii = []
+    elif 'check_cross_message_pii' in stale:
+        cross_message_pii, _, _ = check_cross_message_pii(msg['text'], previous_messages, should_mask=should_mask,
+                                                          current_results=results, lexicon=lexicon)
+        stamp_detectors(msg, ['check_cross_message_pii'])
+    else:
+        cross_message_pii = [detail for detail in msg.get('pii_details', []) if detail.get('is_cross_message')]
+    
+    msg['pii_details'] = detection_details(phone_numbers, has_email, email, should_mask) + cross_message_pii
+    msg['pii_detected'] = len(msg['pii_details']) > 0
+    mark_blocklisted(msg)
+    stamp_detectors(msg, [])
+    msg['revision'] = msg.get('revision', 0) + 1
+    
+    if deferred:
+        # Deep detectors stay unstamped until their results arrive, so a failed run is retried
+        versions = message_rules(msg)['detectors']
+        set_message_rules(msg, {name: version for name, version in versions.items()
+                                if name not in deep_detectors and name != 'check_cross_message_pii'})
+        msg['deep_pending'] = True
+        submit_deep_detection(msg['id'], msg['text'], previous_messages, detector_results, should_mask,
+                              conversation_id, lexicon)
+    return stale
+
+def reevaluate_conversation(messages, max_history=3, defer_deep=False, conversation_id=None):
+    """Re-evaluate the stale messages of a conversation in order.
+    
+    Returns the result of reevaluate_message for each message. Messages still
+    waiting for deep detection are skipped until their results are attached.
+    """
+    outcomes = []
+    last_changed = None
+    for i, msg in enumerate(messages):
+        if msg.get('deep_pending'):
+            outcomes.append(None)
+            continue
+        
+        # Cross-message results depend on what the previous few messages reported
+        force = []
+        if last_changed is not None and i - last_changed <= max_history:
+            force.append('check_cross_message_pii')
+        
+        reported = (history_entry(msg)['phone_numbers'], msg.get('partial_info'))
+        rerun = reevaluate_message(msg, messages[:i], force, defer_deep, conversation_id)
+        if rerun and (history_entry(msg)['phone_numbers'], msg.get('partial_info')) != reported:
+            last_changed = i
+        outcomes.append(rerun)
+    
+    return outcomes
+
+def current_rules():
+    """Fingerprint of the current detector and lexicon versions"""
+    return register_rules({'detectors': dict(detector_versions), 'lexicons': dict(lexicon_versions)})
+
+def reevaluate_session_messages(messages):
+    """Bring the stale messages of the session up to date, returning whether any changed.
+    
+    Re-evaluation runs in a detection slot like a new message, and in async
+    mode the deep detectors are left to the background pool. When no slot is
+    free the stale results are kept until a later page load.
+    """
+    rules = current_rules()
+    if all(msg.get('rules') == rules or msg.get('deep_pending') for msg in messages):
+        return False
+    
+    conversation_id = session.get('conversation_id')
+    defer_deep = app.config['ASYNC_DEEP_DETECTION']
+    if admission_controller is None:
+        outcomes = reevaluate_conversation(messages, defer_deep=defer_deep, conversation_id=conversation_id)
+    else:
+        try:
+            with admission_controller.slot():
+                outcomes = reevaluate_conversation(messages, defer_deep=defer_deep, conversation_id=conversation_id)
+        except AdmissionRejected:
+            return False
+    return any(outcome is not None for outcome in outcomes)
+
+@app.route('/deep_detection/<message_id>', methods=['GET'])
+def deep_detection_status(message_id):
+    """Poll for the deep detection results of a message.
+    
+    The session is never written here: a poll answered after a send would
+    replace the cookie with one missing the message just sent. Finished
+    results are rendered from a copy and stored by the next send or page load.
+    A message this process holds no results for is queued again.
+    """
+    messages = session.get('messages', [])
+    for i, msg in enumerate(messages):
+        if msg.get('id') == message_id:
+            if msg.get('deep_pending'):
+                with deep_detection_lock:
+                    future = deep_detection_results.get(message_id)
+                if future is None:
+                    resubmit_deep_detection(msg, messages[:i], session.get('conversation_id'))
+                    return {'status': 'pending'}
+                if not future.done():
+                    return {'status': 'pending'}
+                msg = copy.deepcopy(msg)
+                attach_deep_results(msg, future)
+            return {
+                'status': 'complete',
+                'pii_detected': msg['pii_detected'],
+                'pii_details': msg['pii_details'],
+                'html': render_template('_message.html', message=msg)
+            }
+    
+    return {'status': 'error', 'message': 'Unknown message'}, 404
+
 @app.route('/toggle_masking', methods=['POST'])
 def toggle_masking():
     """Toggle the PII masking setting"""
     session['mask_pii'] = not get_masking_config()
     return {'status': 'success', 'masking_enabled': session['mask_pii']}
 
+@app.route('/locale', methods=['POST'])
+def set_locale():
+    """Set the language of the conversation's number words, or go back to guessing it"""
+    data = request.get_json(silent=True) or {}
+    locale = data.get('locale') or request.form.get('locale')
+    if not locale:
+        session.pop('locale', None)
+    elif locale not in available_locales():
+        return {'status': 'error', 'message': 'Unknown locale', 'available': available_locales()}, 400
+    else:
+        session['locale'] = locale
+    return {'status': 'success', 'locales': list(get_conversation_locales())}
+
 @app.route('/clear_chat', methods=['POST'])
 def clear_chat():
     """Clear the chat history"""
     if 'messages' in session:
         session['messages'] = []
         session.modified = True
+    session.pop('guessed_locale', None)
+    if conversation_cache is not None and 'conversation_id' in session:
+        conversation_cache.discard(session['conversation_id'])
     return {'status': 'success'}
 
+@app.route('/conversation_cache/stats', methods=['GET'])
+def conversation_cache_stats():
+    """Hit, miss, eviction and memory statistics of the conversation cache"""
+    if conversation_cache is None:
+        return {'status': 'disabled'}
+    return {'status': 'success', 'stats': conversation_cache.stats()}
+
+@app.route('/blocklist/stats', methods=['GET'])
+def blocklist_stats():
+    """Size and modification time of the mapped blocklist"""
+    if blocklist is None:
+        return {'status': 'disabled'}
+    return {'status': 'success', 'stats': blocklist.stats()}
+
+def mark_blocklisted(msg):
+    """Flag the contacts detected in a stored message that are on the blocklist"""
+    if blocklist is None:
+        return
+    
+    listed = False
+    for detail in msg.get('pii_details', []):
+        kind = detail_kinds.get(detail.get('type'))
+        if kind and blocklist.contains(kind, detail['text']):
+            detail['blocklisted'] = listed = True
+        else:
+            detail.pop('blocklisted', None)
+    
+    # Social handles of this message are checked even before they are reported
+    for element in msg.get('partial_info', {}).get('partial_email_elements', []):
+        if element.get('type') == 'social_handle' and blocklist.contains('handle', element['text']):
+            listed = True
+    
+    # Only flagged messages carry the key, to keep the session cookie small
+    if listed:
+        msg['blocklisted'] = True
+    else:
+        msg.pop('blocklisted', None)
+
+def detection_details(phone_numbers, has_email, email, should_mask):
+    """PII details for the phone numbers and email found in a single message"""
+    pii_details = []
+    
+    # Add detected phone numbers, scored by how sure the classifier is of the country
+    for phone in phone_numbers:
+        display_number = mask_phone_number(phone) if should_mask else phone
+        _, confidence = classify_phone_number(phone)
+        pii_details.append({
+            'type': 'PHONE_NUMBER',
+            'text': phone,
+            'display_text': display_number,
+            'score': confidence or 0.85
+        })
+    
+    # Add detected email
+    if has_email and email:  # Make sure email is not None
+        display_email = mask_email(email) if should_mask else email
+        pii_details.append({
+            'type': 'EMAIL_ADDRESS',
+            'text': email,
+            'display_text': display_email,
+            'score': 0.85
+        })
+    
+    return pii_details
+
+def process_message(message):
+    """Run detection on a new message and append it to the chat history"""
+    message_id = uuid.uuid4().hex
+    deep_async = app.config['ASYNC_DEEP_DETECTION']
+    
+    # Get masking configuration
+    should_mask = get_masking_config()
+    
+    conversation_id = get_conversation_id()
+    
+    # Number words of the languages this conversation is written in
+    locales = get_conversation_locales(message)
+    lexicon = get_number_lexicon(locales)
+    
+    # Preprocess message, keeping the results of each detector for later re-evaluation
+    detector_results = detect_by_detector(message, include_deep=not deep_async, lexicon=lexicon)
+    results = combine_detector_results(detector_results)
+    phone_numbers, partial_numbers, has_email, email, partial_email_elements = results
+    
+    # Check for cross-message PII (deferred with the deep detectors in async mode)
+    if deep_async:
+        cross_message_pii = []
+        submit_deep_detection(message_id, message, session['messages'], detector_results, should_mask, conversation_id,
+                              lexicon)
+    else:
+        cross_message_pii, has_cross_email, cross_email = check_cross_message_pii(
+            message, session['messages'], conversation_id=conversation_id, current_results=results, lexicon=lexicon
+        )
+    
+    # Process results
+    pii_details = detection_details(phone_numbers, has_email, email, should_mask)
+    
+    # Add cross-message PII
+    pii_details.extend(cross_message_pii)
+    
+    # Store partial information for future reference (not displayed to user)
+    partial_info = {
+        'partial_numbers': partial_numbers,
+        'partial_email_elements': partial_email_elements
+    }
+    
+    # Add message to chat history
+    stored_message = {
+        'id': message_id,
+        'text': message,
+        'pii_detected': len(pii_details) > 0,
+        'pii_details': pii_details,
+        'partial_info': partial_info,
+        'masking_enabled': should_mask,
+        'locales': list(locales),
+        'deep_pending': deep_async
+    }
+    mark_blocklisted(stored_message)
+    store_detector_results(stored_message, detector_results)
+    if not deep_async:
+        stamp_detectors(stored_message, ['check_cross_message_pii'])
+    session['messages'].append(stored_message)
+    session.modified = True
+    
+    # Keep the extracted state hot for the next message in this conversation
+    remember_message(conversation_id, stored_message)
+    
+    return stored_message
+
+def admit_and_process_message(message):
+    """Charge a message to admission control, then run detection in a bounded slot"""
+    if admission_controller is None:
+        return process_message(message)
+    
+    with admission_controller.admitted(get_conversation_id(), request.remote_addr, len(message),
+                                       len(session['messages'])):
+        return process_message(message)
+
+def retry_after_seconds(error):
+    """Whole seconds a rejected client should wait before trying again"""
+    return max(1, int(math.ceil(error.retry_after)))
+
+@app.errorhandler(AdmissionRejected)
+def admission_rejected(error):
+    """Reject requests refused by admission control with a 429"""
+    retry_after = retry_after_seconds(error)
+    return {
+        'status': 'error',
+        'message': 'Too many messages, please slow down',
+        'reason': error.reason,
+        'retry_after': retry_after
+    }, 429, {'Retry-After': str(retry_after)}
+
+def message_summary(msg):
+    """Client-facing view of a stored message, without the internal partial info"""
+    return {key: value for key, value in msg.items() if key != 'partial_info'}
+
+def history_page(messages, before, limit):
+    """Return the slice of history ending just before the given index"""
+    before = max(0, min(before, len(messages)))
+    first_index = max(0, before - limit)
+    return messages[first_index:before], first_index
+
+@app.route('/messages', methods=['GET'])
+def list_messages():
+    """Page through older chat history as rendered fragments"""
+    messages = session.get('messages', [])
+    before = request.args.get('before', default=len(messages), type=int)
+    limit = request.args.get('limit', default=app.config['HISTORY_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['HISTORY_PAGE_SIZE_MAX']))
+    
+    page, first_index = history_page(messages, before, limit)
+    return {
+        'status': 'success',
+        'messages': [message_summary(msg) for msg in page],
+        'html': ''.join(render_template('_message.html', message=msg) for msg in page),
+        'first_index': first_index,
+        'has_older': first_index > 0
+    }
+
+@app.route('/messages', methods=['POST'])
+def post_message():
+    """Add a message and return only the new message instead of the whole page"""
+    if 'messages' not in session:
+        session['messages'] = []
+    
+    message = request.form.get('message', '')
+    if not message:
+        return {'status': 'error', 'message': 'Message is empty'}, 400
+    
+    # Store deep detection results that finished since the last send, as polls only read them
+    if merge_deep_results(session['messages'], session.get('conversation_id')):
+        session.modified = True
+    
+    stored_message = admit_and_process_message(message)
+    return {
+        'status': 'success',
+        'message': message_summary(stored_message),
+        'html': render_template('_message.html', message=stored_message)
+    }
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if 'messages' not in session:
         session['messages'] = []
     
+    # Pick up deep detection results that finished since the last request
+    if merge_deep_results(session['messages'], session.get('conversation_id')):
+        session.modified = True
+    
+    # Bring results stored under older detector or lexicon versions up to date
+    if reevaluate_session_messages(session['messages']):
+        session.modified = True
+    
+    # A rejected form post shows the page again with the message kept in the box
+    error, draft, headers = None, None, {}
     if request.method == 'POST':
         message = request.form.get('message', '')
         if message:
-            # Preprocess message
-            phone_numbers, partial_numbers, has_email, email, partial_email_elements = preprocess_message(message)
-            
-            # Check for cross-message PII
-            cross_message_pii, has_cross_email, cross_email = check_cross_message_pii(message, session['messages'])
-            
-            # Process results
-            pii_details = []
-            
-            # Get masking configuration
-            should_mask = get_masking_config()
-            
-            # Add detected phone numbers
-            for phone in phone_numbers:
-                display_number = mask_phone_number(phone) if should_mask else phone
-                pii_details.append({
-                    'type': 'PHONE_NUMBER',
-                    'text': phone,
-                    'display_text': display_number,
-                    'score': 0.85
-                })
-            
-            # Add detected email
-            if has_email and email:  # Make sure email is not None
-                display_email = mask_email(email) if should_mask else email
-                pii_details.append({
-                    'type': 'EMAIL_ADDRESS',
-                    'text': email,
-                    'display_text': display_email,
-                    'score': 0.85
-                })
-            
-            # Add cross-message PII
-            pii_details.extend(cross_message_pii)
-            
-            # Store partial information for future reference (not displayed to user)
-            partial_info = {
-                'partial_numbers': partial_numbers,
-                'partial_email_elements': partial_email_elements
-            }
-            
-            # Add message to chat history
-            session['messages'].append({
-                'text': message,
-                'pii_detected': len(pii_details) > 0,
-                'pii_details': pii_details,
-                'partial_info': partial_info,
-                'masking_enabled': should_mask
-            })
-            session.modified = True
-    
-    return render_template('index.html', messages=session['messages'], masking_enabled=get_masking_config())
+            try:
+                admit_and_process_message(message)
+            except AdmissionRejected as rejection:
+                retry_after = retry_after_seconds(rejection)
+                error = 'Too many messages, please wait %d seconds and send again.' % retry_after
+                draft = message
+                headers = {'Retry-After': str(retry_after)}
+    
+    # Only render the most recent page, older messages are loaded on demand
+    messages = session['messages']
+    page, first_index = history_page(messages, len(messages), app.config['HISTORY_PAGE_SIZE'])
+    page_html = render_template('index.html', messages=page, masking_enabled=get_masking_config(),
+                                has_older=first_index > 0, first_index=first_index, error=error, draft=draft)
+    return page_html, 429 if error else 200, headers
 
 if __name__ == '__main__':
     app.run(debug=True) 
\ No newline at end of file
@@ -0,0 +1,236 @@
+"""Blocklist of known leaked or scam contacts, shared by every worker.
+
+The blocklist is a binary file of fixed-width records: a 16-byte header
+followed by the sorted 8-byte hashes of every blocked contact. Workers map
+the file read-only and binary-search it, so the operating system shares one
+copy of the pages between all of them. Nothing is loaded into Python memory,
+and opening the file costs the same whether it holds a thousand contacts or
+millions.
+
+Contacts are normalized before they are hashed: phone numbers to their
+digits, emails and handles to lower case without spaces. The file therefore
+never holds the contacts themselves.
+
+Updates are published by building a new file and renaming it over the old
+one. Workers notice the new file on their next lookup after the check
+interval and map it, while lookups already in progress finish on the old
+mapping.
+
+Examples:
+    python blocklist.py build leaked_contacts.txt --output blocklist.bin
+    python blocklist.py check blocklist.bin 212-555-0147 scammer@example.com
+"""
+import argparse
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PIIBLK01'
+HEADER = struct.Struct('<8sQ')
+RECORD = struct.Struct('<Q')
+
+# Detection types and the kind of contact they are looked up as
+detail_kinds = {
+    'PHONE_NUMBER': 'phone',
+    'EMAIL_ADDRESS': 'email',
+    'SOCIAL_MEDIA': 'handle',
+}
+
+
+class BlocklistError(Exception):
+    """Raised when a blocklist file is missing its header or truncated"""
+
+
+def normalize_contact(kind, value):
+    """Canonical form of a contact, so differently written copies hash the same"""
+    value = value.strip().lower()
+    if kind == 'phone':
+        digits = re.sub(r'\D', '', value)
+        # Numbers dialed with the 00 international prefix are stored as if written with +
+        if digits.startswith('00'):
+            digits = digits[2:]
+        # US/Canada numbers are stored without their country code
+        if len(digits) == 11 and digits.startswith('1'):
+            digits = digits[1:]
+        return digits
+    if kind == 'handle':
+        value = re.sub(r'^(?:https?://)?(?:www\.)?', '', value)
+        return value.lstrip('@')
+    # Emails rebuilt from obfuscated text can keep the spaces around "dot"
+    return re.sub(r'\s+', '', value)
+
+
+def contact_hash(kind, value):
+    """64-bit hash a contact is stored and looked up as"""
+    key = (kind + ':' + normalize_contact(kind, value)).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def guess_kind(value):
+    """Kind of a contact listed without one: email, phone or handle"""
+    value = value.strip()
+    if '@' in value[1:] and '.' in value.rsplit('@', 1)[-1]:
+        return 'email'
+    if len(re.sub(r'\D', '', value)) >= 7 and not re.search(r'[a-zA-Z]', value):
+        return 'phone'
+    return 'handle'
+
+
+class BlocklistMapping:
+    """One blocklist file mapped read-only into memory"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size < HEADER.size:
+                raise BlocklistError('%s is too short to be a blocklist' % path)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+        magic, self.count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise BlocklistError('%s is not a blocklist file' % path)
+        if stat.st_size != HEADER.size + self.count * RECORD.size:
+            raise BlocklistError('%s should hold %d records but is %d bytes' % (path, self.count, stat.st_size))
+
+    def __contains__(self, record):
+        # Binary search over the sorted records
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            value = RECORD.unpack_from(self.data, HEADER.size + middle * RECORD.size)[0]
+            if value < record:
+                low = middle + 1
+            elif value > record:
+                high = middle
+            else:
+                return True
+        return False
+
+
+class Blocklist:
+    """Lookups against a blocklist file that is swapped in place while workers run.
+
+    The file is checked for replacement at most once every `check_interval`
+    seconds. A missing or invalid replacement is logged and the last good
+    mapping is kept.
+    """
+
+    def __init__(self, path, check_interval=5.0, clock=time.monotonic):
+        self.path = path
+        self.check_interval = check_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.mapping = None
+        self.checked = None
+        self.failed_identity = None
+        self.reload()
+
+    def reload(self):
+        """Map the file at `path` again if it was replaced since the last check"""
+        with self.lock:
+            self.checked = self.clock()
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                if self.failed_identity != 'missing':
+                    logger.warning('Blocklist %s not found; contacts are not checked against it', self.path)
+                    self.failed_identity = 'missing'
+                return
+            identity = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if identity in ((self.mapping.identity if self.mapping else None), self.failed_identity):
+                return
+            try:
+                mapping = BlocklistMapping(self.path)
+            except (OSError, ValueError, BlocklistError, struct.error):
+                logger.exception('Failed to map blocklist %s; keeping the previous version', self.path)
+                self.failed_identity = identity
+                return
+            # Lookups still holding the old mapping keep it open until they finish
+            self.mapping = mapping
+            self.failed_identity = None
+            logger.info('Mapped blocklist %s with %d contacts', self.path, mapping.count)
+
+    def contains(self, kind, value):
+        """Whether a contact of the given kind is on the blocklist"""
+        if self.clock() - self.checked >= self.check_interval:
+            self.reload()
+        mapping = self.mapping
+        return mapping is not None and contact_hash(kind, value) in mapping
+
+    def stats(self):
+        """Size and identity of the mapped file"""
+        mapping = self.mapping
+        return {
+            'path': self.path,
+            'contacts': mapping.count if mapping else 0,
+            'mapped_bytes': HEADER.size + mapping.count * RECORD.size if mapping else 0,
+            'modified': mapping.identity[3] / 1e9 if mapping else None,
+        }
+
+
+def read_contacts(paths):
+    """(kind, value) pairs from text files of one contact per line.
+
+    A line is either `kind<TAB>value` or a bare value whose kind is guessed.
+    Blank lines and lines starting with # are skipped.
+    """
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                kind, separator, value = line.partition('\t')
+                if not separator or kind not in detail_kinds.values():
+                    kind, value = guess_kind(line), line
+                yield kind, value
+
+
+def build_blocklist(contacts, output):
+    """Write the contacts as a blocklist file, replacing `output` atomically"""
+    records = sorted({contact_hash(kind, value) for kind, value in contacts})
+    temp_path = '%s.%d.tmp' % (output, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(records)))
+        for start in range(0, len(records), 65536):
+            f.write(b''.join(RECORD.pack(record) for record in records[start:start + 65536]))
+        f.flush()
+        os.fsync(f.fileno())
+    # Workers that already mapped the old file keep reading it until they notice the new one
+    os.replace(temp_path, output)
+    return len(records)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build or query the blocklist of known leaked contacts')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='Build a blocklist file from text files of contacts')
+    build.add_argument('contacts', nargs='+', help='Text files with one contact per line')
+    build.add_argument('--output', default='blocklist.bin', help='Blocklist file to write (default: blocklist.bin)')
+    check = commands.add_parser('check', help='Look contacts up in a blocklist file')
+    check.add_argument('blocklist', help='Blocklist file')
+    check.add_argument('values', nargs='+', help='Contacts to look up')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        count = build_blocklist(read_contacts(args.contacts), args.output)
+        print('Wrote %d contacts to %s in %.2fs' % (count, args.output, time.perf_counter() - start))
+    else:
+        mapping = BlocklistMapping(args.blocklist)
+        for value in args.values:
+            kind = guess_kind(value)
+            listed = contact_hash(kind, value) in mapping
+            print('%-40s %-8s %s' % (value, kind, 'BLOCKED' if listed else 'not listed'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""In-memory cache of per-conversation detection state.
+
+Keeps the recent messages of active conversations with the partial numbers
+and email components already extracted from them, so the cross-message
+checks do not have to reload and reprocess history on every message.
+Entries are evicted least-recently-used first once the byte ceiling is
+reached, or after sitting idle for the TTL. Changes are written behind to a
+persistent store by a background thread.
+"""
+import json
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from sqlite_connections import ThreadLocalConnection
+
+logger = logging.getLogger(__name__)
+
+# Rough per-entry cost of the dict slots, key and bookkeeping tuple
+ENTRY_OVERHEAD_BYTES = 200
+
+# Marks a conversation with no unflushed write
+NOT_PENDING = object()
+
+
+def footprint(value):
+    """Memory taken by a decoded JSON value, counting its nested containers and strings"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(footprint(key) + footprint(item) for key, item in value.items())
+    elif isinstance(value, list):
+        size += sum(footprint(item) for item in value)
+    return size
+
+
+class SQLiteConversationStore:
+    """Persistent conversation state in a SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = ThreadLocalConnection(path)
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS conversation_state ('
+            'conversation_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated REAL NOT NULL)'
+        )
+
+    def load(self, conversation_id):
+        """Serialized state of a conversation, or None"""
+        row = self.connection().execute(
+            'SELECT state FROM conversation_state WHERE conversation_id = ?', (conversation_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def save_many(self, items):
+        """Write (conversation_id, serialized state or None to delete) pairs in one transaction"""
+        connection = self.connection()
+        now = time.time()
+        connection.execute('BEGIN')
+        try:
+            for conversation_id, serialized in items:
+                if serialized is None:
+                    connection.execute('DELETE FROM conversation_state WHERE conversation_id = ?',
+                                       (conversation_id,))
+                else:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO conversation_state (conversation_id, state, updated) '
+                        'VALUES (?, ?, ?)', (conversation_id, serialized, now)
+                    )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def iter_states(self):
+        """Yield (conversation_id, state) for every stored conversation"""
+        for conversation_id, serialized in self.connection().execute(
+                'SELECT conversation_id, state FROM conversation_state ORDER BY conversation_id'):
+            yield conversation_id, json.loads(serialized)
+
+
+class ConversationCache:
+    """LRU + idle-TTL cache with byte accounting and write-behind persistence"""
+
+    def __init__(self, max_bytes, idle_ttl, store=None, flush_interval=2.0, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.store = store
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        # conversation_id -> (state, size in bytes, last access time)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # conversation_id -> serialized state (None for deletions) waiting to be written
+        self.dirty = {}
+        # Writes taken by a flush that is still in progress
+        self.flushing = {}
+        self.flusher = None
+        self.counters = {
+            'hits': 0, 'misses': 0, 'store_loads': 0, 'evictions': 0,
+            'expirations': 0, 'rejected_oversize': 0, 'flushes': 0, 'flushed_entries': 0,
+        }
+
+    def get(self, conversation_id):
+        """Cached state of a conversation, loading it from the store on a miss"""
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(conversation_id)
+            if entry is not None:
+                state, size, last_access = entry
+                if now - last_access <= self.idle_ttl:
+                    self.entries[conversation_id] = (state, size, now)
+                    self.entries.move_to_end(conversation_id)
+                    self.counters['hits'] += 1
+                    return state
+                self.remove(conversation_id)
+                self.counters['expirations'] += 1
+
+            self.counters['misses'] += 1
+            # A write that has not been flushed yet is newer than the store
+            pending = self.dirty.get(conversation_id, self.flushing.get(conversation_id, NOT_PENDING))
+
+        if pending is NOT_PENDING:
+            if self.store is None:
+                return None
+            serialized = self.store.load(conversation_id)
+            if serialized is not None:
+                with self.lock:
+                    self.counters['store_loads'] += 1
+        else:
+            serialized = pending
+        if serialized is None:
+            return None
+
+        state = json.loads(serialized)
+        with self.lock:
+            self.insert(conversation_id, state, footprint(state) + ENTRY_OVERHEAD_BYTES, now)
+        return state
+
+    def put(self, conversation_id, state):
+        """Cache the state of a conversation and queue it for the store"""
+        size = footprint(state) + ENTRY_OVERHEAD_BYTES
+        # Only the write-behind store needs the state serialized
+        serialized = json.dumps(state, separators=(',', ':')) if self.store is not None else None
+        with self.lock:
+            self.insert(conversation_id, state, size, self.clock())
+            if self.store is not None:
+                self.dirty[conversation_id] = serialized
+        self.start_flusher()
+
+    def discard(self, conversation_id):
+        """Drop a conversation from the cache and the store"""
+        with self.lock:
+            self.remove(conversation_id)
+            if self.store is not None:
+                self.dirty[conversation_id] = None
+        self.start_flusher()
+
+    def insert(self, conversation_id, state, size, now):
+        """Add an entry and evict least-recently-used entries down to the byte ceiling (lock held)"""
+        self.remove(conversation_id)
+        if size > self.max_bytes:
+            self.counters['rejected_oversize'] += 1
+            return
+        self.entries[conversation_id] = (state, size, now)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            self.counters['evictions'] += 1
+
+    def remove(self, conversation_id):
+        """Remove an entry and release its bytes (lock held)"""
+        entry = self.entries.pop(conversation_id, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def expire_idle(self):
+        """Evict every entry that has been idle longer than the TTL"""
+        now = self.clock()
+        with self.lock:
+            # Entries are in access order, so stop at the first fresh one
+            while self.entries:
+                conversation_id, (_, _, last_access) = next(iter(self.entries.items()))
+                if now - last_access <= self.idle_ttl:
+                    break
+                self.remove(conversation_id)
+                self.counters['expirations'] += 1
+
+    def flush(self):
+        """Write pending changes to the store"""
+        with self.lock:
+            pending, self.dirty = self.dirty, {}
+            self.flushing = pending
+        if not pending or self.store is None:
+            return
+        try:
+            self.store.save_many(pending.items())
+        except Exception:
+            # Keep the writes for the next flush unless newer ones arrived meanwhile
+            with self.lock:
+                for conversation_id, serialized in pending.items():
+                    self.dirty.setdefault(conversation_id, serialized)
+            raise
+        finally:
+            with self.lock:
+                self.flushing = {}
+        with self.lock:
+            self.counters['flushes'] += 1
+            self.counters['flushed_entries'] += len(pending)
+
+    def start_flusher(self):
+        """Start the background write-behind and expiry thread on first use"""
+        with self.lock:
+            if self.flusher is not None:
+                return
+            self.flusher = threading.Thread(target=self.run_flusher, name='conversation-cache-flusher',
+                                            daemon=True)
+        self.flusher.start()
+
+    def run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.expire_idle()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to write conversation state to the store')
+
+    def stats(self):
+        """Hit, miss and eviction counters plus current memory use"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'pending_writes': len(self.dirty),
+            })
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
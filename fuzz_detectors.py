@@ -0,0 +1,368 @@
+"""Worst-case latency fuzzer for the detectors.
+
+Searches for messages that make each detector, and the cross-message
+combinators, do as much work per byte as possible. Work is counted as the
+number of Python and C function calls made while the target runs, which is
+deterministic and does not depend on how busy the machine is. Work done
+inside a single C call, such as one regex match, counts once, so those paths
+are only covered by the latency thresholds. The search keeps a population of
+the costliest inputs found so far and mutates them with tokens the detectors
+react to (digits, number words, separators, email and handle fragments,
+leetspeak and encoded numbers).
+
+The worst inputs of each target are saved to a regression corpus along with
+their cost and a latency threshold. `--check` replays the corpus and fails
+if any input got slower than its threshold or costlier than its recorded
+cost allows.
+
+Examples:
+    python fuzz_detectors.py --iterations 2000
+    python fuzz_detectors.py --target detect_email --target check_cross_message_pii --seconds 60
+    python fuzz_detectors.py --check
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+import app
+from number_lexicons import number_words_snapshot
+
+# Tokens inserted by the mutations
+fuzz_tokens = (
+    [str(digit) for digit in range(10)]
+    + [' ', '  ', '\n', '\t', '.', '-', '(', ')', '+', '@', '_', '|', '/', '#', '!', '*', ',']
+    + sorted({key.partition(':')[2] for key in number_words_snapshot()})
+    + [variant for variants in app.leetspeak_map.values() for variant in variants if len(variant) > 1]
+    + ['at', 'dot', 'gmail', 'yahoo', 'com', 'net', 'org', 'mail', 'contact', 'user',
+       '0x', '0b', '0o', '&#', ';', '\\u', '\\x', 'fb.me/', 't.me/', 'wa.me/', 'discord.gg/',
+       'instagram.com/', 'tiktok.com/@', '#1234', '___', '(_)', '|_|', '__/', '|__']
+)
+
+# Starting inputs for every target
+seed_messages = [
+    'call me at 212-555-0147',
+    'two one two five five five zero one four seven',
+    'john dot smith at gmail dot com',
+    'reach me: john.smith@gmail.com',
+    '2\n1\n2\n5\n5\n5\n0\n1\n4\n7',
+    '7w0 0n3 7w0 5!x',
+    '0x7e6d8a73 or &#2125550147;',
+    '+44 20 7946 0958',
+    'find me @movingmike or t.me/haulerjane',
+    '212 555 0147 212 555 0147 212 555 0147',
+]
+
+cross_target = 'check_cross_message_pii'
+
+# Longest history the cross-message combinators look at, plus the current message
+max_cross_messages = 4
+
+
+class BudgetExceeded(Exception):
+    """Raised inside a target once it has used up its call budget"""
+
+
+def measure_cost(function, args, max_cost):
+    """Count the calls a target makes, stopping it once it exceeds max_cost.
+
+    Returns (cost, error) where error is the repr of any exception the
+    target raised itself.
+    """
+    calls = [0]
+
+    def profile(frame, event, arg):
+        if event == 'call' or event == 'c_call':
+            calls[0] += 1
+            if calls[0] > max_cost:
+                raise BudgetExceeded()
+
+    error = None
+    sys.setprofile(profile)
+    try:
+        function(*args)
+    except BudgetExceeded:
+        pass
+    except Exception as exc:
+        error = repr(exc)
+    finally:
+        sys.setprofile(None)
+
+    # A bare except in the target can swallow BudgetExceeded, which also unsets the profiler
+    return min(calls[0], max_cost), error
+
+
+def warm_up(function, args):
+    """Run a target once unmeasured so one-time setup such as regex compilation is not counted"""
+    try:
+        function(*args)
+    except Exception:
+        pass
+
+
+def measure_latency(function, args, repeat):
+    """Median wall time of a target in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+# Stored history messages by text, built outside the measured call
+history_messages = {}
+
+
+def stored_message(text):
+    """A history message as process_message would have stored it"""
+    if text not in history_messages:
+        results = app.combine_detector_results(app.detect_by_detector(text))
+        phone_numbers, partial_numbers, has_email, email, partial_email_elements = results
+        history_messages[text] = {
+            'text': text,
+            'pii_details': app.detection_details(phone_numbers, has_email, email, False),
+            'partial_info': {
+                'partial_numbers': partial_numbers,
+                'partial_email_elements': partial_email_elements
+            }
+        }
+    return history_messages[text]
+
+
+def target_call(target, fuzz_input):
+    """Function and arguments that run a target on a fuzz input"""
+    if target == cross_target:
+        history = [stored_message(text) for text in fuzz_input[:-1]]
+        return app.check_cross_message_pii, (fuzz_input[-1], history, 3, True)
+    return app.detector_functions[target], (app.normalize_text(fuzz_input),)
+
+
+def input_size(fuzz_input):
+    """Size of a fuzz input in UTF-8 bytes"""
+    if isinstance(fuzz_input, list):
+        return sum(len(text.encode('utf-8')) for text in fuzz_input)
+    return len(fuzz_input.encode('utf-8'))
+
+
+def mutate_text(rng, text, corpus_texts, max_length):
+    """Apply one random mutation to a message"""
+    choice = rng.randrange(6)
+    position = rng.randint(0, len(text))
+    if choice == 0:
+        # Insert a token
+        text = text[:position] + rng.choice(fuzz_tokens) + text[position:]
+    elif choice == 1:
+        # Insert a repeated run of a token, possibly with a separator
+        token = rng.choice(fuzz_tokens) + rng.choice(['', ' ', '\n', '.', '-'])
+        text = text[:position] + token * rng.randint(2, 32) + text[position:]
+    elif choice == 2 and text:
+        # Delete a span
+        end = min(len(text), position + rng.randint(1, 16))
+        text = text[:position] + text[end:]
+    elif choice == 3 and text:
+        # Repeat a span of the message
+        start = rng.randrange(len(text))
+        span = text[start:start + rng.randint(1, 64)]
+        text = text[:position] + span * rng.randint(1, 8) + text[position:]
+    elif choice == 4 and text:
+        # Replace one character with a token
+        index = rng.randrange(len(text))
+        text = text[:index] + rng.choice(fuzz_tokens) + text[index + 1:]
+    else:
+        # Splice in part of another input
+        other = rng.choice(corpus_texts)
+        start = rng.randint(0, len(other))
+        text = text[:position] + other[start:start + rng.randint(1, 128)] + text[position:]
+    return text[:max_length]
+
+
+def mutate(rng, target, fuzz_input, corpus_texts, max_length):
+    """Apply one to four random mutations to a fuzz input"""
+    if target != cross_target:
+        for _ in range(rng.randint(1, 4)):
+            fuzz_input = mutate_text(rng, fuzz_input, corpus_texts, max_length)
+        return fuzz_input
+
+    fuzz_input = list(fuzz_input)
+    for _ in range(rng.randint(1, 4)):
+        choice = rng.random()
+        if choice < 0.15 and len(fuzz_input) < max_cross_messages:
+            fuzz_input.insert(rng.randint(0, len(fuzz_input)), rng.choice(corpus_texts))
+        elif choice < 0.25 and len(fuzz_input) > 1:
+            del fuzz_input[rng.randrange(len(fuzz_input))]
+        else:
+            index = rng.randrange(len(fuzz_input))
+            fuzz_input[index] = mutate_text(rng, fuzz_input[index], corpus_texts, max_length // max_cross_messages)
+    return fuzz_input
+
+
+def seed_inputs(target, corpus):
+    """Starting inputs for a target, including its saved corpus entries"""
+    saved = [entry['input'] for entry in corpus if entry['target'] == target]
+    if target == cross_target:
+        seeds = [seed_messages[i:i + 3] for i in range(0, len(seed_messages), 3)]
+        seeds.append(['212', '555', '0147'])
+        seeds.append(['john', 'gmail', 'com'])
+        return seeds + saved
+    return list(seed_messages) + saved
+
+
+def fuzz_target(target, corpus, rng, args):
+    """Search for the inputs that make a target do the most work per byte"""
+    population = {}
+    errors = {}
+
+    def evaluate(fuzz_input):
+        key = json.dumps(fuzz_input)
+        if key in population:
+            return
+        function, call_args = target_call(target, fuzz_input)
+        cost, error = measure_cost(function, call_args, args.max_cost)
+        if error is not None:
+            errors.setdefault(error, fuzz_input)
+            return
+        # Ignore the fixed per-call overhead of very short inputs
+        score = cost / max(input_size(fuzz_input), args.min_length)
+        population[key] = (score, cost, fuzz_input)
+        if len(population) > args.population:
+            del population[min(population, key=lambda item: population[item][0])]
+
+    seeds = seed_inputs(target, corpus)
+    for fuzz_input in seeds:
+        warm_up(*target_call(target, fuzz_input))
+    for fuzz_input in seeds:
+        evaluate(fuzz_input)
+
+    deadline = time.monotonic() + args.seconds if args.seconds else None
+    for _ in range(args.iterations):
+        if deadline is not None and time.monotonic() > deadline:
+            break
+        ranked = sorted(population.values(), key=lambda item: item[0], reverse=True)
+        # Favour the costliest inputs as parents
+        parent = ranked[min(int(rng.expovariate(0.5)), len(ranked) - 1)][2]
+        texts = [text for _, _, entry in ranked for text in (entry if isinstance(entry, list) else [entry])]
+        evaluate(mutate(rng, target, parent, texts, args.max_length))
+
+    ranked = sorted(population.values(), key=lambda item: item[0], reverse=True)
+    return ranked[:args.keep], errors
+
+
+def corpus_entry(target, fuzz_input, cost, args):
+    """Regression corpus entry with the measured latency and its threshold"""
+    function, call_args = target_call(target, fuzz_input)
+    latency_ms = measure_latency(function, call_args, args.repeat)
+    return {
+        'target': target,
+        'input': fuzz_input,
+        'bytes': input_size(fuzz_input),
+        'cost': cost,
+        'cost_per_byte': round(cost / max(input_size(fuzz_input), 1), 2),
+        'latency_ms': round(latency_ms, 3),
+        'max_latency_ms': round(max(latency_ms * args.latency_margin, latency_ms + args.latency_floor_ms), 3),
+    }
+
+
+def load_corpus(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)['entries']
+
+
+def save_corpus(path, entries):
+    """Write the corpus through a temporary file so a failed run never leaves half a file"""
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'entries': entries}, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+    os.replace(temp_path, path)
+
+
+def preview(fuzz_input, width=60):
+    text = repr(fuzz_input)
+    return text if len(text) <= width else text[:width - 3] + '...'
+
+
+def check_corpus(entries, args):
+    """Replay the corpus, returning the number of entries over their thresholds"""
+    failures = 0
+    print('%-32s %8s %10s %10s %10s %10s  %s' % ('target', 'bytes', 'cost', 'max cost', 'ms', 'max ms', 'status'))
+    for entry in entries:
+        function, call_args = target_call(entry['target'], entry['input'])
+        warm_up(function, call_args)
+        cost, error = measure_cost(function, call_args, args.max_cost)
+        latency_ms = measure_latency(function, call_args, args.repeat) if error is None else 0.0
+        max_cost = int(entry['cost'] * args.cost_margin)
+
+        status = 'ok'
+        if error is not None:
+            status = 'error ' + error
+        elif cost > max_cost:
+            status = 'costlier'
+        elif latency_ms > entry['max_latency_ms']:
+            status = 'slower'
+        if status != 'ok':
+            failures += 1
+
+        print('%-32s %8d %10d %10d %10.2f %10.2f  %s' % (entry['target'], entry['bytes'], cost, max_cost,
+                                                         latency_ms, entry['max_latency_ms'], status))
+    return failures
+
+
+def main(argv=None):
+    targets = list(app.detector_functions) + [cross_target]
+    parser = argparse.ArgumentParser(description='Search for worst-case inputs of the detectors')
+    parser.add_argument('--target', action='append', choices=targets, help='Target to fuzz (default: all)')
+    parser.add_argument('--corpus', default='fuzz_corpus.json', help='Regression corpus file')
+    parser.add_argument('--check', action='store_true', help='Replay the corpus against its thresholds')
+    parser.add_argument('--iterations', type=int, default=1000, help='Mutations tried per target')
+    parser.add_argument('--seconds', type=float, default=0, help='Time limit per target (0 for none)')
+    parser.add_argument('--max-length', type=int, default=1024, help='Longest input in characters')
+    parser.add_argument('--min-length', type=int, default=64,
+                        help='Inputs shorter than this are scored as if they had this many bytes')
+    parser.add_argument('--max-cost', type=int, default=5000000, help='Call budget per evaluation')
+    parser.add_argument('--population', type=int, default=32)
+    parser.add_argument('--keep', type=int, default=3, help='Worst inputs saved per target')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per latency measurement')
+    parser.add_argument('--latency-margin', type=float, default=3.0,
+                        help='Latency threshold as a multiple of the measured latency')
+    parser.add_argument('--latency-floor-ms', type=float, default=20.0,
+                        help='Minimum headroom between the measured latency and its threshold')
+    parser.add_argument('--cost-margin', type=float, default=1.25,
+                        help='Allowed growth of the call count over the recorded cost')
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args(argv)
+
+    corpus = load_corpus(args.corpus)
+    selected = args.target or targets
+
+    if args.check:
+        entries = [entry for entry in corpus if entry['target'] in selected]
+        failures = check_corpus(entries, args)
+        print()
+        print('%d of %d corpus entries over their thresholds' % (failures, len(entries)))
+        sys.exit(1 if failures else 0)
+
+    rng = random.Random(args.seed)
+    kept = [entry for entry in corpus if entry['target'] not in selected]
+    print('%-32s %8s %10s %10s %10s  %s' % ('target', 'bytes', 'cost', 'cost/byte', 'ms', 'input'))
+    for target in selected:
+        ranked, errors = fuzz_target(target, corpus, rng, args)
+        for _, cost, fuzz_input in ranked:
+            entry = corpus_entry(target, fuzz_input, cost, args)
+            kept.append(entry)
+            print('%-32s %8d %10d %10.2f %10.2f  %s' % (target, entry['bytes'], entry['cost'], entry['cost_per_byte'],
+                                                        entry['latency_ms'], preview(fuzz_input)))
+        for error, fuzz_input in errors.items():
+            print('%-32s raised %s on %s' % (target, error, preview(fuzz_input)))
+
+    kept.sort(key=lambda entry: (targets.index(entry['target']), -entry['cost_per_byte']))
+    save_corpus(args.corpus, kept)
+
+
+if __name__ == '__main__':
+    main()
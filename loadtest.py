@@ -0,0 +1,404 @@
+"""Local load generator for the chat application.
+
+Drives the Flask routes with many concurrent simulated conversations and
+reports throughput, latency percentiles, response and cookie sizes and
+server RSS as the conversation history grows.
+
+Examples:
+    python loadtest.py --spawn --conversations 40 --messages 30 --concurrency 8
+    python loadtest.py --url http://127.0.0.1:5000 --server-pid 12345
+    python loadtest.py --spawn --send /messages
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+# Filler text for messages without contact information
+chatter = [
+    "Hi, is the couch still available?",
+    "What size truck will you be using for the move?",
+    "I can do pickup on Saturday morning if that works",
+    "The crate is about 4 feet by 3 feet and around 80 lbs",
+    "Can you send more photos of the item?",
+    "Price is a bit high, would you take less?",
+    "Delivery would be to the north side of town",
+    "Thanks, I'll check with my partner and get back to you",
+    "Do you offer insurance on the shipment?",
+    "Sounds good, let's confirm the date later this week",
+]
+
+number_words = ['zero', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine']
+leet_digits = {'0': 'o', '1': 'l', '3': 'e', '4': 'a', '5': 's', '7': 't', '8': 'B'}
+email_users = ['jsmith', 'movingmike', 'haulerjane', 'bigtruck88', 'shipfast']
+email_domains = ['gmail', 'yahoo', 'hotmail', 'outlook', 'icloud']
+
+
+def random_phone(rng):
+    """Generate a random valid NANP phone number"""
+    area_code = rng.choice([201, 212, 305, 312, 415, 503, 617, 702, 713, 808, 903, 917])
+    exchange = rng.randint(200, 999)
+    if exchange % 100 == 11:
+        exchange += 1
+    return '%d%d%04d' % (area_code, exchange, rng.randint(0, 9999))
+
+
+def plain_phone(rng):
+    number = random_phone(rng)
+    return ["Call me at %s-%s-%s" % (number[:3], number[3:6], number[6:])]
+
+
+def spelled_phone(rng):
+    number = random_phone(rng)
+    words = [number_words[int(d)] if rng.random() < 0.5 else d for d in number]
+    return ["my number is " + ' '.join(words)]
+
+
+def leetspeak_phone(rng):
+    number = random_phone(rng)
+    return ["text me " + ''.join(leet_digits.get(d, d) for d in number)]
+
+
+def split_phone(rng):
+    number = random_phone(rng)
+    return [number[:3], "then " + number[3:7], "and " + number[7:]]
+
+
+def obfuscated_email(rng):
+    user = rng.choice(email_users)
+    domain = rng.choice(email_domains)
+    return ["reach me at %s at %s dot com" % (user, domain)]
+
+
+def split_email(rng):
+    return [rng.choice(email_users), rng.choice(email_domains), "com"]
+
+
+def social_handle(rng):
+    return ["find me on t.me/%s or @%s" % (rng.choice(email_users), rng.choice(email_users))]
+
+
+def long_paste(rng):
+    lines = [rng.choice(chatter) for _ in range(rng.randint(40, 120))]
+    if rng.random() < 0.5:
+        lines.insert(rng.randrange(len(lines)), plain_phone(rng)[0])
+    return ['\n'.join(lines)]
+
+
+def small_talk(rng):
+    return [rng.choice(chatter)]
+
+
+# Relative weights of each message kind in a simulated conversation
+message_mix = [
+    (60, small_talk),
+    (6, plain_phone),
+    (6, spelled_phone),
+    (5, leetspeak_phone),
+    (5, split_phone),
+    (5, obfuscated_email),
+    (4, split_email),
+    (5, social_handle),
+    (4, long_paste),
+]
+
+
+def generate_conversation(rng, length):
+    """Build the list of messages sent by one simulated conversation"""
+    weights = [weight for weight, _ in message_mix]
+    generators = [generator for _, generator in message_mix]
+    messages = []
+    while len(messages) < length:
+        generator = rng.choices(generators, weights=weights)[0]
+        messages.extend(generator(rng))
+    return messages[:length]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def read_rss_kb(pid):
+    """Read the resident set size of a process from /proc (Linux only)"""
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def child_pids(pid):
+    """List the direct children of a process, e.g. pre-forked server workers"""
+    children = []
+    try:
+        for task in os.listdir('/proc/%d/task' % pid):
+            with open('/proc/%d/task/%s/children' % (pid, task)) as handle:
+                children.extend(int(child) for child in handle.read().split())
+    except (OSError, ValueError):
+        pass
+    return children
+
+
+class Results:
+    """Thread-safe collection of request samples and RSS readings"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+        self.rss = []
+        self.max_history = 0
+
+    def record(self, sample):
+        with self.lock:
+            self.samples.append(sample)
+            if sample.get('send'):
+                self.max_history = max(self.max_history, sample['history'])
+
+    def record_rss(self, readings):
+        with self.lock:
+            self.rss.append({'history': self.max_history, 'workers': readings})
+
+
+def timed_request(opener, url, data=None):
+    """Send one request and return (status, latency in seconds, response bytes)"""
+    body = urllib.parse.urlencode(data).encode() if data is not None else None
+    start = time.perf_counter()
+    try:
+        with opener.open(url, data=body, timeout=120) as response:
+            payload = response.read()
+            status = response.status
+    except urllib.error.HTTPError as error:
+        payload = error.read()
+        status = error.code
+    except (urllib.error.URLError, OSError):
+        payload = b''
+        status = 0
+    return status, time.perf_counter() - start, len(payload)
+
+
+def run_conversation(base_url, messages, results, rng, clear_at_end, send_path='/'):
+    """Replay one conversation with its own cookie jar"""
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+
+    status, latency, size = timed_request(opener, base_url + '/')
+    results.record({'endpoint': 'GET /', 'history': 0, 'status': status,
+                    'latency': latency, 'bytes': size, 'cookie_bytes': 0})
+
+    for history, message in enumerate(messages):
+        # Occasionally flip the masking setting like a real user would
+        if rng.random() < 0.03:
+            status, latency, size = timed_request(opener, base_url + '/toggle_masking', {})
+            results.record({'endpoint': '/toggle_masking', 'history': history, 'status': status,
+                            'latency': latency, 'bytes': size,
+                            'cookie_bytes': sum(len(cookie.value) for cookie in jar)})
+
+        status, latency, size = timed_request(opener, base_url + send_path, {'message': message})
+        results.record({'endpoint': send_path, 'history': history, 'status': status,
+                        'latency': latency, 'bytes': size, 'send': True,
+                        'cookie_bytes': sum(len(cookie.value) for cookie in jar)})
+
+    # Page back through the history the way the client loads older messages
+    if send_path == '/messages':
+        status, latency, size = timed_request(opener, base_url + '/messages?before=%d' % len(messages))
+        results.record({'endpoint': 'GET /messages', 'history': len(messages), 'status': status,
+                        'latency': latency, 'bytes': size,
+                        'cookie_bytes': sum(len(cookie.value) for cookie in jar)})
+
+    if clear_at_end:
+        status, latency, size = timed_request(opener, base_url + '/clear_chat', {})
+        results.record({'endpoint': '/clear_chat', 'history': len(messages), 'status': status,
+                        'latency': latency, 'bytes': size,
+                        'cookie_bytes': sum(len(cookie.value) for cookie in jar)})
+
+
+def sample_rss(pids, results, stop, interval):
+    """Periodically record the RSS of the server process and its workers"""
+    while not stop.wait(interval):
+        readings = {}
+        for pid in pids:
+            for worker in [pid] + child_pids(pid):
+                rss = read_rss_kb(worker)
+                if rss is not None:
+                    readings[worker] = rss
+        if readings:
+            results.record_rss(readings)
+
+
+def wait_for_port(host, port, timeout):
+    """Wait until the server accepts connections"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def spawn_server(port, env_overrides):
+    """Start the application on a local port using the Flask CLI"""
+    env = dict(os.environ)
+    env.update(env_overrides)
+    command = [sys.executable, '-m', 'flask', '--app', 'app', 'run',
+               '--host', '127.0.0.1', '--port', str(port), '--no-reload', '--no-debugger']
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not wait_for_port('127.0.0.1', port, timeout=120):
+        server.terminate()
+        raise RuntimeError('Server did not start on port %d' % port)
+    return server
+
+
+def summarize(samples, elapsed, rss, bucket_size):
+    """Aggregate samples into an overall and per-history-bucket report"""
+    def stats(group):
+        latencies = [s['latency'] * 1000 for s in group]
+        return {
+            'requests': len(group),
+            'errors': sum(1 for s in group if s['status'] not in (200, 429)),
+            'rejected': sum(1 for s in group if s['status'] == 429),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'avg_response_bytes': int(sum(s['bytes'] for s in group) / len(group)),
+            'avg_cookie_bytes': int(sum(s['cookie_bytes'] for s in group) / len(group)),
+        }
+
+    report = {
+        'elapsed_s': round(elapsed, 2),
+        'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        'endpoints': {},
+        'history_buckets': [],
+    }
+
+    for endpoint in sorted(set(s['endpoint'] for s in samples)):
+        report['endpoints'][endpoint] = stats([s for s in samples if s['endpoint'] == endpoint])
+
+    sends = [s for s in samples if s.get('send')]
+    buckets = {}
+    for sample in sends:
+        buckets.setdefault(sample['history'] // bucket_size, []).append(sample)
+    for bucket in sorted(buckets):
+        low = bucket * bucket_size
+        entry = {'history': '%d-%d' % (low, low + bucket_size - 1)}
+        entry.update(stats(buckets[bucket]))
+        # Latest RSS reading taken while the longest history was in this bucket
+        readings = [r for r in rss if r['history'] // bucket_size == bucket]
+        if readings:
+            entry['rss_mb'] = {str(pid): round(kb / 1024.0, 1) for pid, kb in readings[-1]['workers'].items()}
+        report['history_buckets'].append(entry)
+
+    return report
+
+
+def print_report(report):
+    """Print the report as plain text tables"""
+    print('Elapsed: %.2fs  Throughput: %.2f req/s' % (report['elapsed_s'], report['throughput_rps']))
+    print()
+    header = '%-18s %8s %6s %8s %9s %9s %9s %10s %10s'
+    row = '%-18s %8d %6d %8d %9.2f %9.2f %9.2f %10d %10d'
+    print(header % ('endpoint', 'requests', 'errors', 'rejected', 'p50 ms', 'p95 ms', 'p99 ms',
+                    'resp B', 'cookie B'))
+    for endpoint, s in report['endpoints'].items():
+        print(row % (endpoint, s['requests'], s['errors'], s['rejected'], s['p50_ms'], s['p95_ms'],
+                     s['p99_ms'], s['avg_response_bytes'], s['avg_cookie_bytes']))
+    print()
+    print((header + ' %s') % ('history', 'requests', 'errors', 'rejected', 'p50 ms', 'p95 ms', 'p99 ms',
+                              'resp B', 'cookie B', 'RSS MB per worker'))
+    for s in report['history_buckets']:
+        rss = ', '.join('%s=%s' % item for item in sorted(s.get('rss_mb', {}).items()))
+        print((row + ' %s') % (s['history'], s['requests'], s['errors'], s['rejected'], s['p50_ms'],
+                               s['p95_ms'], s['p99_ms'], s['avg_response_bytes'], s['avg_cookie_bytes'], rss))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the chat application')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='Base URL of a running server')
+    parser.add_argument('--spawn', action='store_true', help='Start a local server for the run')
+    parser.add_argument('--port', type=int, default=5055, help='Port used with --spawn')
+    parser.add_argument('--server-pid', type=int, action='append', default=[],
+                        help='PID of a running server to sample RSS from (repeatable)')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Environment for the spawned server, e.g. ASYNC_DEEP_DETECTION=1')
+    parser.add_argument('--send', choices=['/', '/messages'], default='/',
+                        help='Send through the full-page form post or the JSON fragment API')
+    parser.add_argument('--conversations', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=30, help='Messages per conversation')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--bucket', type=int, default=5, help='History bucket size in the report')
+    parser.add_argument('--rss-interval', type=float, default=0.5)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    server = None
+    base_url = args.url.rstrip('/')
+    pids = list(args.server_pid)
+    if args.spawn:
+        server = spawn_server(args.port, dict(item.split('=', 1) for item in args.env))
+        base_url = 'http://127.0.0.1:%d' % args.port
+        pids.append(server.pid)
+
+    rng = random.Random(args.seed)
+    conversations = [(generate_conversation(rng, args.messages), random.Random(rng.random()))
+                     for _ in range(args.conversations)]
+
+    results = Results()
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_rss, args=(pids, results, stop, args.rss_interval), daemon=True)
+    sampler.start()
+
+    queue = list(reversed(conversations))
+    queue_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with queue_lock:
+                if not queue:
+                    return
+                messages, conversation_rng = queue.pop()
+            run_conversation(base_url, messages, results, conversation_rng, clear_at_end=True,
+                             send_path=args.send)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        elapsed = time.perf_counter() - start
+        stop.set()
+        sampler.join()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = summarize(results.samples, elapsed, results.rss, args.bucket)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""Number-word lexicons per locale.
+
+Each locale pack in lexicons/<locale>.json lists the words for the digits in
+one language, plus a few very common words used to guess the language of a
+conversation. Packs are read on first use. Each combination of locales is
+compiled once into lookup tables, so the cost of looking up a word does not
+grow as languages are added.
+
+Stopwords are kept to words that are not also common in another installed
+language, English included. `python number_lexicons.py --check` guesses the
+language of a set of plain English messages and fails if any of them is taken
+for another language.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+
+LEXICON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lexicons')
+
+# Fuzzy matches remembered per compiled lexicon before the memo is reset
+MAX_REMEMBERED_MATCHES = 100000
+
+# Stopword hits a message needs before its language is guessed
+MIN_LANGUAGE_HITS = 2
+
+# Stopword hits the guessed language needs over the runner-up, English included
+MIN_LANGUAGE_MARGIN = 2
+
+# Ordinary English messages that must never be guessed as another language
+english_samples = [
+    'I need a truck and a trailer',
+    'I want a quote for a move',
+    'Is the sofa still available? I can pick it up on Saturday',
+    'Do you have a number I can call?',
+    'I am moving from Las Vegas to Los Angeles next month',
+    'Can you do a premium package with a drum kit and a piano?',
+    'Yes, a van is fine. Mon or Tue works for me',
+    'Hi, I saw your ad. Is a pickup at 5 ok?',
+    'Thanks! I will send the address later',
+    'No problem, see you then',
+]
+
+packs = {}
+lexicons = {}
+stopword_locales = None
+lock = threading.Lock()
+
+
+def available_locales():
+    """Codes of every installed locale pack, in file name order"""
+    return sorted(name[:-len('.json')] for name in os.listdir(LEXICON_DIR) if name.endswith('.json'))
+
+
+def load_pack(locale):
+    """The parsed pack of a locale, read on first use"""
+    with lock:
+        if locale not in packs:
+            with open(os.path.join(LEXICON_DIR, locale + '.json'), encoding='utf-8') as f:
+                packs[locale] = json.load(f)
+        return packs[locale]
+
+
+class FuzzyMatches(dict):
+    """Memo of the digit each unknown word fuzzily matches, filled in on lookup"""
+
+    def __init__(self, lexicon):
+        super().__init__()
+        self.lexicon = lexicon
+
+    def __missing__(self, word):
+        digit = self.lexicon.fuzzy_match(word)
+        if len(self) >= MAX_REMEMBERED_MATCHES:
+            self.clear()
+        self[word] = digit
+        return digit
+
+
+class NumberLexicon:
+    """Number words of one or more locales compiled for lookups independent of lexicon size.
+
+    `words` maps each number word to its digit in match order. A word that is
+    not in the lexicon matches the first number word that contains it or is
+    contained in it, which `matches[word]` answers with dictionary lookups
+    over the substrings of the word instead of a scan of every number word.
+    """
+
+    def __init__(self, locales, words):
+        self.locales = locales
+        self.words = words
+        self.rank = {word: index for index, word in enumerate(words)}
+        self.digits = list(words.values())
+        self.max_length = max(len(word) for word in words)
+        self.first_chars = {word[0] for word in words}
+
+        # Earliest number word containing each substring
+        self.containing = {}
+        for word, index in self.rank.items():
+            for start in range(len(word)):
+                for end in range(start + 1, len(word) + 1):
+                    self.containing.setdefault(word[start:end], index)
+
+        self.matches = FuzzyMatches(self)
+
+    def __reduce__(self):
+        # Worker processes rebuild the lexicon from its locales instead of copying the tables
+        return get_number_lexicon, (self.locales,)
+
+    def fuzzy_match(self, word):
+        """Digit of the first number word that contains `word` or is contained in it, or ''"""
+        best = self.containing.get(word) if len(word) <= self.max_length else None
+
+        for start in range(len(word)):
+            if word[start] not in self.first_chars:
+                continue
+            for end in range(start + 1, min(len(word), start + self.max_length) + 1):
+                index = self.rank.get(word[start:end])
+                if index is not None and (best is None or index < best):
+                    best = index
+
+        return self.digits[best] if best is not None else ''
+
+
+def get_number_lexicon(locales):
+    """Compiled lexicon for a sequence of locales, built on first use"""
+    locales = tuple(locales)
+    lexicon = lexicons.get(locales)
+    if lexicon is None:
+        words = {}
+        for locale in locales:
+            for word, digit in load_pack(locale)['number_words'].items():
+                words.setdefault(word, digit)
+        lexicon = NumberLexicon(locales, words)
+        with lock:
+            lexicon = lexicons.setdefault(locales, lexicon)
+    return lexicon
+
+
+def guess_locale(text):
+    """Locale whose common words clearly dominate a message, or None"""
+    global stopword_locales
+    if stopword_locales is None:
+        index = {}
+        for locale in available_locales():
+            for word in load_pack(locale)['stopwords']:
+                index.setdefault(word, []).append(locale)
+        stopword_locales = index
+
+    hits = {}
+    for word in re.findall(r'\w+', text.lower()):
+        for locale in stopword_locales.get(word, ()):
+            hits[locale] = hits.get(locale, 0) + 1
+    if not hits:
+        return None
+
+    ranked = sorted(hits.items(), key=lambda item: item[1], reverse=True)
+    best, best_hits = ranked[0]
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0
+    if best_hits < MIN_LANGUAGE_HITS or best_hits - runner_up < MIN_LANGUAGE_MARGIN:
+        return None
+    return best
+
+
+def number_words_snapshot():
+    """Number words of every installed pack as 'locale:word' -> digit, in pack order"""
+    return {locale + ':' + word: digit
+            for locale in available_locales()
+            for word, digit in load_pack(locale)['number_words'].items()}
+
+
+def check_guesses(samples=english_samples):
+    """Print the guess for each English sample, returning the number taken for another language"""
+    failures = 0
+    for text in samples:
+        guessed = guess_locale(text)
+        status = 'ok' if guessed in (None, 'en') else 'guessed ' + guessed
+        if status != 'ok':
+            failures += 1
+        print('%-64s %s' % (text, status))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the language guesses of the installed locale packs')
+    parser.add_argument('--check', action='store_true', help='Fail if an English sample is guessed as another language')
+    parser.add_argument('text', nargs='*', help='Messages to guess the language of')
+    args = parser.parse_args(argv)
+
+    for text in args.text:
+        print('%-64s %s' % (text, guess_locale(text)))
+    if args.check:
+        failures = check_guesses()
+        print()
+        print('%d of %d English samples guessed as another language' % (failures, len(english_samples)))
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
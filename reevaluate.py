@@ -0,0 +1,90 @@
+"""Re-evaluate stored conversations after a detector or lexicon change.
+
+Reads conversations exported as JSON, either a list of stored messages or an
+object mapping conversation ids to lists of stored messages, and re-runs only
+the detectors whose version changed, or whose lexicon changed in a way that
+touches a message. Messages that are already current are left untouched.
+
+Set LEXICON_SNAPSHOTS to the same file the servers use. It holds the version
+tables behind the messages' rule fingerprints and the old lexicon contents,
+so changes can be narrowed down to the affected detectors and messages;
+without it every detector is re-run on messages stamped with older rules.
+
+Examples:
+    python reevaluate.py conversations.json --dry-run
+    python reevaluate.py conversations.json --output conversations.new.json
+"""
+import argparse
+import copy
+import json
+import os
+import time
+from collections import Counter
+
+import app
+
+
+def reevaluate_export(conversations):
+    """Re-evaluate every conversation in place, returning counters of what was done"""
+    counters = Counter()
+    detectors = Counter()
+    for messages in conversations.values():
+        counters['conversations'] += 1
+        for outcome in app.reevaluate_conversation(messages):
+            counters['messages'] += 1
+            if outcome is None:
+                counters['current'] += 1
+            elif not outcome:
+                counters['restamped'] += 1
+            else:
+                counters['reevaluated'] += 1
+                detectors.update(outcome)
+    return counters, detectors
+
+
+def print_report(counters, detectors, elapsed):
+    print('Conversations: %d  Messages: %d  Elapsed: %.2fs' % (counters['conversations'], counters['messages'], elapsed))
+    print('Current: %d  Restamped only: %d  Re-evaluated: %d' % (counters['current'], counters['restamped'],
+                                                                  counters['reevaluated']))
+    if detectors:
+        print()
+        print('%-32s %10s' % ('detector', 'messages'))
+        for name, count in detectors.most_common():
+            print('%-32s %10d' % (name, count))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Re-evaluate stored conversations under the current rules')
+    parser.add_argument('export', help='JSON file of stored conversations')
+    parser.add_argument('--output', help='Where to write the re-evaluated conversations (default: in place)')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be re-evaluated')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    with open(args.export, encoding='utf-8') as f:
+        data = json.load(f)
+    conversations = {'conversation': data} if isinstance(data, list) else data
+    if args.dry_run:
+        conversations = copy.deepcopy(conversations)
+        # The snapshots were read at import; a dry run must not record new rule fingerprints in them
+        app.app.config['LEXICON_SNAPSHOTS'] = ''
+
+    start = time.perf_counter()
+    counters, detectors = reevaluate_export(conversations)
+    elapsed = time.perf_counter() - start
+
+    if not args.dry_run and (args.output or counters['restamped'] or counters['reevaluated']):
+        output = args.output or args.export
+        temp_path = '%s.%d.tmp' % (output, os.getpid())
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data if isinstance(data, list) else conversations, f, ensure_ascii=False)
+        os.replace(temp_path, output)
+
+    if args.json:
+        print(json.dumps({'elapsed_s': round(elapsed, 3), 'counters': counters, 'detectors': detectors}, indent=2))
+    else:
+        print_report(counters, detectors, elapsed)
+
+
+if __name__ == '__main__':
+    main()
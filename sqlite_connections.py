@@ -0,0 +1,24 @@
+"""Per-thread SQLite connections shared by the SQLite-backed stores.
+
+A SQLite connection must not be shared between threads, so each thread gets
+its own, opened in autocommit mode with write-ahead logging so readers and
+the writer of other processes do not block each other.
+"""
+import sqlite3
+import threading
+
+
+class ThreadLocalConnection:
+    """Callable returning the current thread's connection to a SQLite file"""
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def __call__(self):
+        if not hasattr(self.local, 'connection'):
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+        return self.local.connection